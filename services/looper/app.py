@@ -6,12 +6,47 @@ import os
 import base64
 import logging
 import random
+import asyncio
+import signal
+import multiprocessing
+from engine import OpenLoop
+from replay import TraceReplay
 
 logger = logging.getLogger("looper")
 
 dotenv.load_dotenv()
 
 INTERVAL = int(os.environ.get('INTERVAL', '6'))
+MODE = os.environ.get('MODE') or 'closed'
+
+# Open-loop mode: target rate, arrival process, concurrency cap and how to split
+# requests over routes ("<METHOD> <tail>") and credential sets (the two entries
+# of `headers`, then anonymous)
+RATE = float(os.environ.get('RATE') or '10')
+ARRIVAL = os.environ.get('ARRIVAL') or 'poisson'
+MAX_IN_FLIGHT = int(os.environ.get('MAX_IN_FLIGHT') or '100')
+DURATION = float(os.environ['DURATION']) if os.environ.get('DURATION') else None
+ROUTE_WEIGHTS = (
+    os.environ.get('ROUTE_WEIGHTS')
+    or '{"GET 01": 1, "GET 02": 1, "GET 03": 1, "GET single": 1, "POST single": 4}'
+)
+HEADER_WEIGHTS = os.environ.get('HEADER_WEIGHTS') or '[1, 1, 0]'
+
+# Replay mode: JSONL export of `kong-log` records and how much faster than
+# recorded to send them
+REPLAY_FILE = os.environ.get('REPLAY_FILE') or 'kong-log.jsonl'
+SPEEDUP = float(os.environ.get('SPEEDUP') or '1')
+
+# Coordinator/worker modes: a coordinator splits RATE over every worker process
+# connected to the same Redis, on this host (WORKERS processes) or others, and
+# merges their latency histograms into REPORT_FILE at the end
+REDIS_URL = os.environ.get('REDIS_URL') or 'redis://localhost:6379/1'
+WORKERS = int(os.environ.get('WORKERS') or '1')
+RUN_ID = os.environ.get('RUN_ID') or None
+START_DELAY = float(os.environ.get('START_DELAY') or '3')
+REPORT_INTERVAL = float(os.environ.get('REPORT_INTERVAL') or '10')
+REPORT_FILE = os.environ.get('REPORT_FILE') or 'looper-report.json'
+
 address = os.environ.get('ADDRESS', 'empty')
 if address == 'empty':
     raise Exception('EMPTY ADDRESS')
@@ -21,13 +56,12 @@ URL = address
 if 'http' not in URL:
     URL = 'http://' + URL
 
+GATEWAY = URL + ':8000'
+
 URL += ':8000/service-'
 
 tails = ['01', '02', '03', 'single']
 
-itr = 0
-
-
 headers = [
     {'Authorization': f'Basic %s' % base64.b64encode(b"dummy:dummy").decode()},
     {'Authorization': f'Basic %s' % base64.b64encode(b"dummier:dummier").decode()},
@@ -35,34 +69,159 @@ headers = [
 
 range_1, range_2 = (0, 15), (0, 6)
 
-while True:
-    itr += 1
-    for tail in tails:
-        for _ in range(random.randint(*range_1)):
-            requests.get(URL + tail, headers=headers[0])
-            logging.info(f"Called [GET] {URL + tail}")
+
+def closed_loop():
+    itr = 0
+    while True:
+        itr += 1
+        for tail in tails:
+            for _ in range(random.randint(*range_1)):
+                requests.get(URL + tail, headers=headers[0])
+                logging.info(f"Called [GET] {URL + tail}")
+                requests.post(
+                    URL + tails[-1], 
+                    json={
+                        'itr': itr,
+                        'test': True
+                    },
+                    headers=headers[0]
+                )
+                logging.info(f"Called [POST] {URL + tails[-1]}")
+
+        for _ in range(random.randint(*range_2)):
+            requests.get(URL + tails[-1])
+            logging.info(f"Called [GET] {URL + tails[-1]}")
             requests.post(
                 URL + tails[-1], 
                 json={
                     'itr': itr,
                     'test': True
                 },
-                headers=headers[0]
+                headers=headers[1]
             )
             logging.info(f"Called [POST] {URL + tails[-1]}")
 
-    for _ in range(random.randint(*range_2)):
-        requests.get(URL + tails[-1])
-        logging.info(f"Called [GET] {URL + tails[-1]}")
-        requests.post(
-            URL + tails[-1], 
-            json={
-                'itr': itr,
-                'test': True
-            },
-            headers=headers[1]
+        time.sleep(INTERVAL)
+
+
+def open_loop():
+    logging.basicConfig(level=logging.INFO)
+    engine = OpenLoop(
+        URL,
+        routes=json.loads(ROUTE_WEIGHTS),
+        headers=[*headers, {}],
+        header_weights=json.loads(HEADER_WEIGHTS),
+        rate=RATE,
+        arrival=ARRIVAL,
+        max_in_flight=MAX_IN_FLIGHT,
+        duration=DURATION,
+    )
+    stats = asyncio.run(engine.run())
+    logger.info(f"finished: {stats}")
+
+
+def replay():
+    logging.basicConfig(level=logging.INFO)
+    engine = TraceReplay(
+        GATEWAY,
+        REPLAY_FILE,
+        credentials={'dummy': headers[0], 'dummier': headers[1]},
+        speedup=SPEEDUP,
+        max_in_flight=MAX_IN_FLIGHT,
+    )
+    stats = asyncio.run(engine.run())
+    logger.info(f"finished: {stats}, skipped records: {engine.skipped}")
+
+
+def coordinator():
+    import redis.asyncio as redis
+    from cluster import Coordinator
+
+    logging.basicConfig(level=logging.INFO)
+
+    async def run():
+        client = redis.Redis.from_url(REDIS_URL)
+        coordinator = Coordinator(
+            client,
+            rate=RATE,
+            duration=DURATION,
+            arrival=ARRIVAL,
+            routes=json.loads(ROUTE_WEIGHTS),
+            header_weights=json.loads(HEADER_WEIGHTS),
+            run_id=RUN_ID,
+            start_delay=START_DELAY,
+            report_interval=REPORT_INTERVAL,
         )
-        logging.info(f"Called [POST] {URL + tails[-1]}")
+        loop = asyncio.get_running_loop()
+        for signum in [signal.SIGINT, signal.SIGTERM]:
+            loop.add_signal_handler(signum, coordinator.stop)
+        try:
+            return await coordinator.run()
+        finally:
+            await client.aclose()
+
+    report = asyncio.run(run())
+    with open(REPORT_FILE, 'w') as file:
+        json.dump(report, file, indent=2)
+    logger.info(f"report written to {REPORT_FILE}")
+
+
+def make_engine(config):
+    # The engine stops on its own at the end of the run, in case the
+    # coordinator is gone by then
+    duration = None
+    if config['duration'] is not None:
+        duration = config['start_at'] + config['duration'] - time.time()
+    return OpenLoop(
+        URL,
+        routes=config['routes'],
+        headers=[*headers, {}],
+        header_weights=config['header_weights'],
+        rate=config['rate'],
+        arrival=config['arrival'],
+        max_in_flight=MAX_IN_FLIGHT,
+        duration=duration,
+    )
+
+
+def worker_process():
+    import redis.asyncio as redis
+    from cluster import Worker
+
+    logging.basicConfig(level=logging.INFO)
+
+    async def run():
+        client = redis.Redis.from_url(REDIS_URL)
+        try:
+            await Worker(client, make_engine).run()
+        finally:
+            await client.aclose()
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
+
+
+def worker():
+    # One event loop per process, so a host's cores all send
+    if WORKERS == 1:
+        return worker_process()
+    processes = [multiprocessing.Process(target=worker_process) for _ in range(WORKERS)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+
 
-    time.sleep(INTERVAL)
-    
+if __name__ == '__main__':
+    if MODE == 'open':
+        open_loop()
+    elif MODE == 'replay':
+        replay()
+    elif MODE == 'coordinator':
+        coordinator()
+    elif MODE == 'worker':
+        worker()
+    else:
+        closed_loop()
@@ -0,0 +1,257 @@
+import os
+import json
+import time
+import uuid
+import socket
+import asyncio
+import logging
+from histogram import Histogram
+
+logger = logging.getLogger("looper")
+
+# Everything a run keeps in Redis expires a day after it was last written
+KEY_TTL = 24 * 3600
+
+
+def keys(run_id: str) -> dict:
+    return {
+        "state": f"looper:{run_id}:state",
+        "workers": f"looper:{run_id}:workers",
+        "rates": f"looper:{run_id}:rates",
+        "reports": f"looper:{run_id}:reports",
+    }
+
+
+def merge_reports(reports: list) -> dict:
+    # Per route and over all routes, from the workers' cumulative reports
+    routes = {}
+    stats = {"scheduled": 0, "sent": 0, "completed": 0, "errors": 0, "dropped": 0, "status": {}}
+    for report in reports:
+        for route, histograms in report["latencies"].items():
+            merged = routes.setdefault(route, {"response": Histogram(), "service": Histogram()})
+            for kind in merged:
+                merged[kind].merge(Histogram.from_dict(histograms[kind]))
+        for key, value in report["stats"].items():
+            if key == "status":
+                for status, count in value.items():
+                    stats["status"][status] = stats["status"].get(status, 0) + count
+            else:
+                stats[key] += value
+    total = {"response": Histogram(), "service": Histogram()}
+    for merged in routes.values():
+        for kind in total:
+            total[kind].merge(merged[kind])
+    return {
+        "stats": stats,
+        "all": {kind: histogram.summary() for kind, histogram in total.items()},
+        "routes": {
+            route: {kind: histogram.summary() for kind, histogram in merged.items()}
+            for route, merged in sorted(routes.items())
+        },
+    }
+
+
+class Coordinator:
+    # Announces a run in Redis and keeps splitting `rate` evenly over the
+    # workers that heartbeat for it, so the offered load stays the same when
+    # workers join or leave. Workers push their cumulative histograms, which
+    # are merged here into periodic and final reports.
+    def __init__(
+        self,
+        redis,
+        rate: float,
+        duration: float = None,
+        arrival: str = "poisson",
+        routes: dict = None,
+        header_weights: list = None,
+        run_id: str = None,
+        start_delay: float = 3,
+        worker_timeout: float = 5,
+        report_interval: float = 10,
+        drain_timeout: float = 15,
+    ):
+        self.redis = redis
+        self.run_id = run_id or uuid.uuid4().hex[:12]
+        self.keys = keys(self.run_id)
+        self.config = {
+            "id": self.run_id,
+            "rate": rate,
+            "duration": duration,
+            "arrival": arrival,
+            "routes": routes,
+            "header_weights": header_weights,
+        }
+        self.start_delay = start_delay
+        self.worker_timeout = worker_timeout
+        self.report_interval = report_interval
+        self.drain_timeout = drain_timeout
+        self.stopping = False
+
+    def stop(self):
+        self.stopping = True
+
+    async def live_workers(self) -> list:
+        now = time.time()
+        await self.redis.zremrangebyscore(self.keys["workers"], 0, now - self.worker_timeout)
+        return sorted(
+            worker.decode() for worker in await self.redis.zrange(self.keys["workers"], 0, -1)
+        )
+
+    async def assign(self, workers: list):
+        pipe = self.redis.pipeline()
+        pipe.delete(self.keys["rates"])
+        if workers:
+            share = self.config["rate"] / len(workers)
+            pipe.hset(self.keys["rates"], mapping={worker: share for worker in workers})
+            pipe.expire(self.keys["rates"], KEY_TTL)
+        await pipe.execute()
+
+    async def report(self, started: float, stopped: float = None) -> dict:
+        raw = await self.redis.hgetall(self.keys["reports"])
+        reports = [json.loads(value) for value in raw.values()]
+        merged = merge_reports(reports)
+        elapsed = max((stopped or time.time()) - started, 1e-9)
+        merged.update(
+            run_id=self.run_id,
+            target_rps=self.config["rate"],
+            offered_rps=merged["stats"]["scheduled"] / elapsed,
+            completed_rps=merged["stats"]["completed"] / elapsed,
+            elapsed_s=elapsed,
+            workers=len(reports),
+            final=stopped is not None,
+        )
+        logger.info(
+            f"{len(reports)} worker(s), offered {merged['offered_rps']:.1f} rps, "
+            f"completed {merged['completed_rps']:.1f} rps, response {merged['all']['response']}"
+        )
+        return merged
+
+    async def run(self) -> dict:
+        start_at = time.time() + self.start_delay
+        self.config["start_at"] = start_at
+        await self.redis.set(self.keys["state"], "running", ex=KEY_TTL)
+        # Announced last, so workers find the state already set
+        await self.redis.set("looper:run", json.dumps(self.config), ex=KEY_TTL)
+        logger.info(f"run {self.run_id} starts at {start_at:.3f}: {self.config}")
+
+        workers = []
+        next_report = start_at + self.report_interval
+        while not self.stopping:
+            now = time.time()
+            if self.config["duration"] is not None and now >= start_at + self.config["duration"]:
+                break
+            live = await self.live_workers()
+            if live != workers:
+                logger.info(f"workers: {live}")
+                workers = live
+            # Rewritten every second, so a worker that restarted gets its share back
+            await self.assign(workers)
+            if now >= next_report:
+                await self.report(start_at)
+                next_report += self.report_interval
+            await asyncio.sleep(1)
+
+        # Workers finish their in-flight requests and push a last report
+        stopped = time.time()
+        await self.redis.set(self.keys["state"], "stopping", ex=KEY_TTL)
+        deadline = time.time() + self.drain_timeout
+        while time.time() < deadline:
+            raw = await self.redis.hgetall(self.keys["reports"])
+            if all(json.loads(value).get("done") for value in raw.values()):
+                break
+            await asyncio.sleep(0.5)
+        await self.redis.set(self.keys["state"], "stopped", ex=KEY_TTL)
+        return await self.report(start_at, stopped)
+
+
+class Worker:
+    # Waits for a run announced by a Coordinator, then sends its share of the
+    # run's rate with an OpenLoop engine from `make_engine(config)`, starting
+    # at the run's common start time. Every second it heartbeats and picks up
+    # its current share; every `report_interval` (and when done) it pushes its
+    # cumulative histograms.
+    def __init__(self, redis, make_engine, worker_id: str = None, report_interval: float = 5):
+        self.redis = redis
+        self.make_engine = make_engine
+        self.worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}"
+        self.report_interval = report_interval
+
+    async def wait_for_run(self, seen: set) -> dict:
+        while True:
+            raw = await self.redis.get("looper:run")
+            if raw is not None:
+                config = json.loads(raw)
+                state = await self.redis.get(keys(config["id"])["state"])
+                if config["id"] not in seen and state == b"running":
+                    return config
+            await asyncio.sleep(1)
+
+    async def push(self, run_keys: dict, engine, done: bool = False):
+        report = {
+            "worker": self.worker_id,
+            "stats": engine.stats.snapshot(),
+            "latencies": engine.latencies.to_dict(),
+            "done": done,
+        }
+        await self.redis.hset(run_keys["reports"], self.worker_id, json.dumps(report))
+        await self.redis.expire(run_keys["reports"], KEY_TTL)
+
+    async def heartbeat(self, run_keys: dict):
+        await self.redis.zadd(run_keys["workers"], {self.worker_id: time.time()})
+        await self.redis.expire(run_keys["workers"], KEY_TTL)
+
+    async def rate(self, run_keys: dict):
+        share = await self.redis.hget(run_keys["rates"], self.worker_id)
+        return float(share) if share is not None else None
+
+    async def control(self, run_keys: dict, engine, task):
+        next_push = time.time() + self.report_interval
+        while not task.done():
+            await self.heartbeat(run_keys)
+            share = await self.rate(run_keys)
+            if share:
+                engine.rate = share
+            state = await self.redis.get(run_keys["state"])
+            if state != b"running":
+                engine.stop()
+            if time.time() >= next_push:
+                await self.push(run_keys, engine)
+                next_push += self.report_interval
+            await asyncio.sleep(1)
+
+    async def run_once(self, config: dict) -> dict:
+        run_keys = keys(config["id"])
+        await self.heartbeat(run_keys)
+        # The coordinator hands out shares about once a second
+        share = None
+        while not share:
+            if await self.redis.get(run_keys["state"]) != b"running":
+                return None
+            share = await self.rate(run_keys)
+            if not share:
+                await asyncio.sleep(0.5)
+                await self.heartbeat(run_keys)
+        logger.info(f"{self.worker_id} joins run {config['id']} at {share:.1f} rps")
+
+        # Late joiners start right away
+        delay = config["start_at"] - time.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        engine = self.make_engine({**config, "rate": share})
+        task = asyncio.create_task(engine.run())
+        control = asyncio.create_task(self.control(run_keys, engine, task))
+        try:
+            stats = await task
+        finally:
+            control.cancel()
+            await self.push(run_keys, engine, done=True)
+            await self.redis.zrem(run_keys["workers"], self.worker_id)
+        logger.info(f"{self.worker_id} finished run {config['id']}: {stats}")
+        return stats
+
+    async def run(self):
+        seen = set()
+        while True:
+            config = await self.wait_for_run(seen)
+            seen.add(config["id"])
+            await self.run_once(config)
@@ -0,0 +1,217 @@
+import abc
+import time
+import random
+import asyncio
+import logging
+import aiohttp
+from urllib.parse import urlsplit
+from histogram import Histogram
+
+logger = logging.getLogger("looper")
+
+
+# Seconds until the next arrival at `rate` per second. Drawn one at a time, so
+# the rate can change while running.
+ARRIVALS = {
+    "constant": lambda rate, rng: 1 / rate,
+    "poisson": lambda rate, rng: rng.expovariate(rate),
+}
+
+
+class Stats:
+    def __init__(self):
+        self.scheduled = 0
+        self.sent = 0
+        self.completed = 0
+        self.errors = 0
+        self.dropped = 0
+        self.status = {}
+
+    def snapshot(self) -> dict:
+        return {
+            "scheduled": self.scheduled,
+            "sent": self.sent,
+            "completed": self.completed,
+            "errors": self.errors,
+            "dropped": self.dropped,
+            "status": dict(self.status),
+        }
+
+
+class Latencies:
+    # Per route, two histograms: `response` from when the request was due to
+    # be sent, `service` from when it actually was. Only the first is free of
+    # coordinated omission: a stalled event loop or a full pool delays sends,
+    # and that wait is part of what a real client would have seen.
+    def __init__(self):
+        self.routes = {}
+
+    # A dropped request was never served, so it only has a response time
+    def record(self, route: str, response_s: float, service_s: float = None):
+        if route not in self.routes:
+            self.routes[route] = {"response": Histogram(), "service": Histogram()}
+        self.routes[route]["response"].record(response_s)
+        if service_s is not None:
+            self.routes[route]["service"].record(service_s)
+
+    def merged(self, kind: str = "response") -> Histogram:
+        merged = Histogram()
+        for histograms in self.routes.values():
+            merged.merge(histograms[kind])
+        return merged
+
+    def to_dict(self) -> dict:
+        return {
+            route: {kind: histogram.to_dict() for kind, histogram in histograms.items()}
+            for route, histograms in self.routes.items()
+        }
+
+
+class Engine(abc.ABC):
+    # Shared by the load modes: one keep-alive connection pool, at most
+    # `max_in_flight` open requests, and periodic rate reports. A request that
+    # is due while every slot is taken is dropped and counted instead of being
+    # delayed, so the offered load stays the one configured. Its response time
+    # is recorded as the timeout, as a client giving up would have seen it.
+    def __init__(
+        self, max_in_flight: int = 100, timeout: float = 10, report_interval: float = 10
+    ):
+        self.max_in_flight = max_in_flight
+        self.timeout = timeout
+        self.report_interval = report_interval
+        self.stats = Stats()
+        self.latencies = Latencies()
+        self.itr = 0
+        self.stopping = False
+
+    def stop(self):
+        # Takes effect at the next scheduled request
+        self.stopping = True
+
+    # Histogram label of a request
+    def route(self, method, url):
+        return f"{method} {urlsplit(url).path}"
+
+    # Failed requests are recorded too, with the time it took them to fail
+    async def fire(self, session, slots, method, url, headers, body=None, due=None):
+        loop = asyncio.get_running_loop()
+        sent = loop.time()
+        try:
+            self.stats.sent += 1
+            kwargs = {"headers": headers}
+            if body is not None:
+                kwargs["json"] = body
+            async with session.request(method, url, **kwargs) as response:
+                await response.read()
+                self.stats.status[response.status] = (
+                    self.stats.status.get(response.status, 0) + 1
+                )
+            self.stats.completed += 1
+            logger.debug(f"Called [{method}] {url}")
+        except (aiohttp.ClientError, asyncio.TimeoutError) as err:
+            self.stats.errors += 1
+            logger.debug(f"Failed [{method}] {url}: {err!r}")
+        finally:
+            slots.release()
+            done = loop.time()
+            self.latencies.record(
+                self.route(method, url), done - (due if due is not None else sent), done - sent
+            )
+
+    async def report(self, started: float):
+        while True:
+            await asyncio.sleep(self.report_interval)
+            elapsed = time.monotonic() - started
+            snapshot = self.stats.snapshot()
+            logger.info(
+                f"offered {snapshot['scheduled'] / elapsed:.1f} rps, "
+                f"completed {snapshot['completed'] / elapsed:.1f} rps, "
+                f"{snapshot}, latency {self.latencies.merged().summary()}"
+            )
+
+    # Yields (delay from start in seconds, request arguments for fire())
+    @abc.abstractmethod
+    def schedule(self):
+        ...
+
+    async def run(self) -> dict:
+        loop = asyncio.get_running_loop()
+        slots = asyncio.Semaphore(self.max_in_flight)
+        connector = aiohttp.TCPConnector(limit=self.max_in_flight)
+        timeout = aiohttp.ClientTimeout(total=self.timeout)
+        pending = set()
+
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+            started = time.monotonic()
+            reporter = asyncio.create_task(self.report(started))
+            start_at = loop.time()
+            try:
+                # Absolute schedule, so slow iterations do not lower the rate
+                for offset, request in self.schedule():
+                    await asyncio.sleep(max(0, start_at + offset - loop.time()))
+                    if self.stopping:
+                        break
+                    self.stats.scheduled += 1
+                    self.itr += 1
+                    if slots.locked():
+                        self.stats.dropped += 1
+                        self.latencies.record(self.route(*request[:2]), self.timeout)
+                        continue
+                    await slots.acquire()
+                    task = asyncio.create_task(
+                        self.fire(session, slots, *request, due=start_at + offset)
+                    )
+                    pending.add(task)
+                    task.add_done_callback(pending.discard)
+                if pending:
+                    await asyncio.wait(pending)
+            finally:
+                reporter.cancel()
+
+        return self.stats.snapshot()
+
+
+class OpenLoop(Engine):
+    # Synthetic traffic started on a fixed schedule (constant or Poisson
+    # arrivals at `rate` per second) no matter how long earlier requests take,
+    # spread over "<METHOD> <tail>" routes and credential sets by weight.
+    def __init__(
+        self,
+        url: str,
+        routes: dict,
+        headers: list,
+        header_weights: list,
+        rate: float,
+        arrival: str = "poisson",
+        max_in_flight: int = 100,
+        duration: float = None,
+        timeout: float = 10,
+        report_interval: float = 10,
+        seed: int = None,
+    ):
+        assert arrival in ARRIVALS
+        super().__init__(max_in_flight, timeout, report_interval)
+        self.url = url
+        self.routes = [route.split(" ", 1) for route in routes]
+        self.route_weights = list(routes.values())
+        self.headers = headers
+        self.header_weights = header_weights
+        self.rate = rate
+        self.arrival = arrival
+        self.duration = duration
+        self.rng = random.Random(seed)
+
+    def pick(self):
+        method, tail = self.rng.choices(self.routes, self.route_weights)[0]
+        headers = self.rng.choices(self.headers, self.header_weights)[0]
+        body = {"itr": self.itr, "test": True} if method == "POST" else None
+        return method, self.url + tail, headers, body
+
+    # `rate` is read before every arrival, so it can be changed while running
+    def schedule(self):
+        offset = 0
+        while True:
+            offset += ARRIVALS[self.arrival](self.rate, self.rng)
+            if self.duration is not None and offset >= self.duration:
+                return
+            yield offset, self.pick()
@@ -0,0 +1,83 @@
+import math
+
+
+class Histogram:
+    # HDR-style latency histogram over integer microseconds: exact below
+    # 2 * 10^digits, then log-linear buckets that keep `digits` significant
+    # decimal digits at any magnitude. Counts are sparse, so an empty route
+    # costs nothing, and histograms recorded anywhere merge by adding counts.
+    def __init__(self, digits: int = 3):
+        self.digits = digits
+        self.sub_bits = math.ceil(math.log2(2 * 10**digits))
+        self.half = 1 << (self.sub_bits - 1)
+        self.counts = {}
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def index(self, value: int) -> int:
+        bucket = max(0, value.bit_length() - self.sub_bits)
+        return bucket * self.half + (value >> bucket)
+
+    # Middle of the values sharing the bucket
+    def value(self, index: int) -> int:
+        bucket = max(0, (index >> (self.sub_bits - 1)) - 1)
+        lowest = (index - bucket * self.half) << bucket
+        return lowest + ((1 << bucket) >> 1)
+
+    def record(self, seconds: float, count: int = 1):
+        value = max(0, int(seconds * 1e6))
+        idx = self.index(value)
+        self.counts[idx] = self.counts.get(idx, 0) + count
+        self.total += count
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def merge(self, other: "Histogram"):
+        assert other.digits == self.digits
+        for idx, count in other.counts.items():
+            self.counts[idx] = self.counts.get(idx, 0) + count
+        self.total += other.total
+        if other.min is not None:
+            self.min = other.min if self.min is None else min(self.min, other.min)
+            self.max = other.max if self.max is None else max(self.max, other.max)
+        return self
+
+    # In milliseconds
+    def percentile(self, percent: float):
+        if not self.total:
+            return None
+        rank = max(1, math.ceil(self.total * percent / 100))
+        seen = 0
+        for idx in sorted(self.counts):
+            seen += self.counts[idx]
+            if seen >= rank:
+                value = min(max(self.value(idx), self.min), self.max)
+                return value / 1000
+        return self.max / 1000
+
+    def summary(self, percents=(50, 90, 99, 99.9)) -> dict:
+        summary = {"count": self.total}
+        if self.total:
+            summary.update(
+                {f"p{percent:g}_ms": self.percentile(percent) for percent in percents}
+            )
+            summary["max_ms"] = self.max / 1000
+        return summary
+
+    def to_dict(self) -> dict:
+        return {
+            "digits": self.digits,
+            "counts": sorted(self.counts.items()),
+            "min": self.min,
+            "max": self.max,
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "Histogram":
+        histogram = cls(data["digits"])
+        histogram.counts = {idx: count for idx, count in data["counts"]}
+        histogram.total = sum(histogram.counts.values())
+        histogram.min = data["min"]
+        histogram.max = data["max"]
+        return histogram
@@ -0,0 +1,82 @@
+import json
+import logging
+from datetime import datetime
+from engine import Engine
+
+logger = logging.getLogger("looper")
+
+BODY_METHODS = ["POST", "PUT", "PATCH"]
+
+
+def read_records(path: str):
+    # One Kong log record per line, either as shipped to `kong-log` or wrapped
+    # in an Elasticsearch hit ({"_source": {...}}). The file is never loaded
+    # as a whole.
+    with open(path, "r") as file:
+        for number, line in enumerate(file, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                logger.warning(f"skip malformed line {number}")
+                continue
+            yield record.get("_source", record)
+
+
+def record_time(record) -> float:
+    # Seconds since epoch, from Kong's own start time when present
+    if "started_at" in record:
+        return record["started_at"] / 1000
+    return datetime.fromisoformat(record["@timestamp"].replace("Z", "+00:00")).timestamp()
+
+
+class TraceReplay(Engine):
+    # Re-issues exported Kong requests against `gateway` with their original
+    # inter-arrival times, divided by `speedup`. The consumer of each record
+    # picks the credentials (consumers without known credentials go out
+    # anonymously), and requests that carried a body get one of the same
+    # length.
+    def __init__(
+        self,
+        gateway: str,
+        path: str,
+        credentials: dict,
+        speedup: float = 1,
+        max_in_flight: int = 100,
+        timeout: float = 10,
+        report_interval: float = 10,
+    ):
+        super().__init__(max_in_flight, timeout, report_interval)
+        self.gateway = gateway.rstrip("/")
+        self.path = path
+        self.credentials = credentials
+        self.speedup = speedup
+        self.skipped = 0
+
+    def to_request(self, record):
+        request = record["request"]
+        method = request.get("method", "GET")
+        consumer = (record.get("consumer") or {}).get("username")
+        headers = self.credentials.get(consumer, {})
+        body = None
+        if method in BODY_METHODS:
+            length = int((request.get("headers") or {}).get("content-length", 0))
+            body = {"itr": self.itr, "test": True, "pad": ""}
+            body["pad"] = "x" * max(0, length - len(json.dumps(body)))
+        return method, self.gateway + request["uri"], headers, body
+
+    def schedule(self):
+        first = None
+        for record in read_records(self.path):
+            try:
+                at = record_time(record)
+                request = self.to_request(record)
+            except (KeyError, TypeError, ValueError):
+                self.skipped += 1
+                continue
+            if first is None:
+                first = at
+            # Records a little out of order are sent right away
+            yield max(0, at - first) / self.speedup, request
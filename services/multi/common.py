@@ -0,0 +1,286 @@
+import os
+import sys
+import json
+import time
+import queue
+import atexit
+import signal
+import logging
+import threading
+from collections import OrderedDict, deque
+import dotenv
+import requests
+from concurrent.futures import ThreadPoolExecutor, wait
+from requests.adapters import HTTPAdapter
+from py_zipkin.zipkin import zipkin_client_span
+from py_zipkin.storage import get_default_tracer
+from py_zipkin.request_helpers import create_http_headers
+from py_zipkin.transport import BaseTransportHandler
+
+# The apps load .env after their imports, so do it here before reading config
+dotenv.load_dotenv()
+
+logger = logging.getLogger('multi')
+
+# Connections kept open per downstream host and threads for concurrent calls
+POOL_SIZE = int(os.environ.get('DOWNSTREAM_POOL_SIZE') or '32')
+# (connect, read) timeout in seconds for every downstream call
+TIMEOUT = tuple(json.loads(os.environ.get('DOWNSTREAM_TIMEOUT') or '[1, 10]'))
+
+SESSION = requests.Session()
+SESSION.mount('http://', HTTPAdapter(pool_connections=4, pool_maxsize=POOL_SIZE))
+
+EXECUTOR = ThreadPoolExecutor(max_workers=POOL_SIZE, thread_name_prefix='downstream')
+
+
+def call(service_name, span_name, url, tracer):
+    # py_zipkin keeps the current span in a thread local, so the worker gets a
+    # copy of the caller's tracer: same span storage (the spans are sent with
+    # the caller's root span), own context stack (concurrent calls do not see
+    # each other's client span as parent)
+    with zipkin_client_span(service_name=service_name, span_name=span_name, _tracer=tracer) as span:
+        headers = create_http_headers(tracer=tracer)
+        response = SESSION.get(url, headers=headers, timeout=TIMEOUT)
+        # Lets the tail sampler keep traces with failed downstream calls
+        span.update_binary_annotations({'http.status_code': str(response.status_code)})
+        if response.status_code >= 500:
+            span.update_binary_annotations({'error': f'HTTP {response.status_code}'})
+        return response.status_code
+
+
+def fan_out(calls):
+    # Runs (service_name, span_name, url) calls at the same time from inside a
+    # zipkin_span and returns their status codes in order. Every call finishes
+    # before this returns, so all client spans are recorded before the root
+    # span is reported; the first error is raised after that.
+    tracer = get_default_tracer()
+    futures = [EXECUTOR.submit(call, *args, tracer.copy()) for args in calls]
+    wait(futures)
+    return [future.result() for future in futures]
+
+
+class TailSampler:
+    # Decides per trace which spans are forwarded, after they have been
+    # recorded. A trace is kept when its id hashes below `rate` (the same
+    # traces in every service, so they stay complete), when one of its spans
+    # has an error tag, or when its slowest span took longer than `slow_ms`
+    # or the `slow_percentile` of recent traces. Spans of undecided traces wait
+    # up to `window` seconds for a later span to qualify, then are dropped;
+    # past `max_spans` buffered spans the oldest traces are evicted.
+    #
+    # Latency and errors add up towards the root, so a trace kept for being
+    # slow or failing in one service usually is in its callers too.
+    # Only used from the reporter thread, hence no locking.
+    def __init__(self, rate=0.1, slow_ms=None, slow_percentile=99, window=5.0, max_spans=10000, history=1000):
+        self.rate = rate
+        self.slow_ms = slow_ms
+        self.slow_percentile = slow_percentile
+        self.window = window
+        self.max_spans = max_spans
+        self.durations = deque(maxlen=history)
+        # The threshold is recomputed after every 100 new durations
+        self.observed = 0
+        self.next_update = 100
+        self.threshold = None
+        self.pending = OrderedDict()
+        self.pending_spans = 0
+        self.kept = OrderedDict()
+        self.counters = {'sampled_traces': 0, 'slow_traces': 0, 'error_traces': 0, 'dropped_traces': 0, 'evicted_traces': 0}
+
+    def sampled(self, trace_id):
+        return int(trace_id[-16:], 16) < self.rate * 2 ** 64
+
+    def slow(self, duration_us):
+        if self.slow_ms is not None and duration_us > self.slow_ms * 1000:
+            return True
+        return self.threshold is not None and duration_us > self.threshold
+
+    def update_threshold(self):
+        if self.slow_percentile is None or len(self.durations) < 100:
+            return
+        ordered = sorted(self.durations)
+        self.threshold = ordered[min(len(ordered) - 1, int(len(ordered) * self.slow_percentile / 100))]
+
+    def reason(self, trace_id, spans):
+        if any('error' in span.get('tags', {}) for span in spans):
+            return 'error'
+        if self.slow(max(span.get('duration', 0) for span in spans)):
+            return 'slow'
+        if self.sampled(trace_id):
+            return 'sampled'
+        return None
+
+    def remember(self, trace_id):
+        self.kept[trace_id] = True
+        if len(self.kept) > 10000:
+            self.kept.popitem(last=False)
+
+    def offer(self, spans, now):
+        # Returns the spans that can be forwarded right away
+        traces = {}
+        for span in spans:
+            traces.setdefault(span['traceId'], []).append(span)
+        forward = []
+        for trace_id, trace_spans in traces.items():
+            if trace_id in self.kept:
+                forward.extend(trace_spans)
+                continue
+            self.durations.append(max(span.get('duration', 0) for span in trace_spans))
+            self.observed += 1
+            started, buffered = self.pending.pop(trace_id, (now, []))
+            self.pending_spans -= len(buffered)
+            buffered.extend(trace_spans)
+            reason = self.reason(trace_id, buffered)
+            if reason:
+                self.counters[f'{reason}_traces'] += 1
+                self.remember(trace_id)
+                forward.extend(buffered)
+            else:
+                self.pending[trace_id] = (started, buffered)
+                self.pending_spans += len(buffered)
+        while self.pending_spans > self.max_spans:
+            _, (_, buffered) = self.pending.popitem(last=False)
+            self.pending_spans -= len(buffered)
+            self.counters['evicted_traces'] += 1
+        if self.observed >= self.next_update:
+            self.next_update = self.observed + 100
+            self.update_threshold()
+        return forward
+
+    def expire(self, now):
+        while self.pending:
+            trace_id, (started, buffered) = next(iter(self.pending.items()))
+            if now - started < self.window:
+                break
+            del self.pending[trace_id]
+            self.pending_spans -= len(buffered)
+            self.counters['dropped_traces'] += 1
+
+    def stats(self):
+        return {**self.counters, 'pending_traces': len(self.pending), 'slow_threshold_us': self.threshold}
+
+
+class SpanReporter(BaseTransportHandler):
+    # Transport handler for zipkin_span that only puts the encoded spans on a
+    # bounded queue. A background thread sends them to the collector as one V2
+    # JSON list per `batch_size` spans or per `flush_interval` seconds,
+    # whichever comes first. When the queue is full, drop="newest" rejects the
+    # incoming payload and drop="oldest" evicts the oldest queued one. Failed
+    # POSTs are not retried. Everything still queued is sent on close().
+    # With a TailSampler, only the spans it keeps are sent.
+    def __init__(self, url, batch_size=100, flush_interval=1.0, queue_size=1000, drop='newest', timeout=(1, 5), sampler=None):
+        assert drop in ['newest', 'oldest']
+        self.url = url
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.drop = drop
+        self.timeout = timeout
+        self.sampler = sampler
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.counters = {'queued': 0, 'dropped': 0, 'sent_spans': 0, 'sent_batches': 0, 'failed_spans': 0, 'failed_batches': 0}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._loop, name='span-reporter', daemon=True)
+        self._thread.start()
+
+    def _count(self, key, value=1):
+        with self._lock:
+            self.counters[key] += value
+
+    def stats(self):
+        with self._lock:
+            stats = {**self.counters, 'backlog': self.queue.qsize()}
+        if self.sampler is not None:
+            stats.update(self.sampler.stats())
+        return stats
+
+    def get_max_payload_bytes(self):
+        return None
+
+    def send(self, payload):
+        while True:
+            try:
+                self.queue.put_nowait(payload)
+                self._count('queued')
+                return
+            except queue.Full:
+                if self.drop == 'newest':
+                    self._count('dropped')
+                    return
+            try:
+                self.queue.get_nowait()
+                self._count('dropped')
+            except queue.Empty:
+                pass
+
+    def _post(self, spans):
+        try:
+            response = SESSION.post(self.url, data=json.dumps(spans), headers={'Content-Type': 'application/json'}, timeout=self.timeout)
+            response.raise_for_status()
+            self._count('sent_spans', len(spans))
+            self._count('sent_batches')
+        except requests.RequestException as err:
+            self._count('failed_spans', len(spans))
+            self._count('failed_batches')
+            logger.warning('could not report %d spans: %r', len(spans), err)
+
+    def _loop(self):
+        spans = []
+        deadline = time.monotonic() + self.flush_interval
+        while not (self._stop.is_set() and self.queue.empty()):
+            try:
+                payload = self.queue.get(timeout=max(0, deadline - time.monotonic()))
+                # Decoded here, off the request path
+                decoded = json.loads(payload)
+                if self.sampler is not None:
+                    decoded = self.sampler.offer(decoded, time.monotonic())
+                spans.extend(decoded)
+            except queue.Empty:
+                pass
+            if self.sampler is not None:
+                self.sampler.expire(time.monotonic())
+            if len(spans) >= self.batch_size or time.monotonic() >= deadline:
+                for start in range(0, len(spans), self.batch_size):
+                    self._post(spans[start:start + self.batch_size])
+                spans = []
+                deadline = time.monotonic() + self.flush_interval
+        for start in range(0, len(spans), self.batch_size):
+            self._post(spans[start:start + self.batch_size])
+
+    def close(self, timeout=10):
+        self._stop.set()
+        self._thread.join(timeout)
+        logger.info('span reporter closed: %s', self.stats())
+
+
+def span_reporter(zipkin_url):
+    # Reporter configured from the environment, flushed when the process exits
+    # (including on SIGTERM from `docker stop`)
+    reporter = SpanReporter(
+        f'{zipkin_url}/api/v2/spans',
+        batch_size=int(os.environ.get('ZIPKIN_BATCH_SIZE') or '100'),
+        flush_interval=float(os.environ.get('ZIPKIN_FLUSH_INTERVAL') or '1'),
+        queue_size=int(os.environ.get('ZIPKIN_QUEUE_SIZE') or '1000'),
+        drop=os.environ.get('ZIPKIN_DROP') or 'newest',
+        sampler=tail_sampler(),
+    )
+    atexit.register(reporter.close)
+    if signal.getsignal(signal.SIGTERM) == signal.SIG_DFL:
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    return reporter
+
+
+def tail_sampler():
+    # TRACE_SAMPLE_RATE=1 forwards every trace and disables the sampler
+    rate = float(os.environ.get('TRACE_SAMPLE_RATE') or '0.1')
+    if rate >= 1:
+        return None
+    slow_ms = os.environ.get('TRACE_SLOW_MS')
+    slow_percentile = os.environ.get('TRACE_SLOW_PERCENTILE') or '99'
+    return TailSampler(
+        rate=rate,
+        slow_ms=float(slow_ms) if slow_ms else None,
+        slow_percentile=float(slow_percentile) if slow_percentile != 'none' else None,
+        window=float(os.environ.get('TRACE_BUFFER_SECONDS') or '5'),
+        max_spans=int(os.environ.get('TRACE_BUFFER_SPANS') or '10000'),
+    )
@@ -1,12 +1,11 @@
 import sys
 import time
-import requests
 import dotenv
 import os
 from flask import Flask, request
-from py_zipkin.zipkin import zipkin_span, create_http_headers_for_new_span, ZipkinAttrs, Kind, zipkin_client_span
-from py_zipkin.request_helpers import create_http_headers
+from py_zipkin.zipkin import zipkin_span, create_http_headers_for_new_span, ZipkinAttrs, Kind
 from py_zipkin.encoding import Encoding
+from common import fan_out, span_reporter
 
 dotenv.load_dotenv()
 
@@ -19,16 +18,7 @@ ZIPKIN_URL = f'http://{address}:9411'
 
 app = Flask(__name__)
 
-def default_handler(encoded_span):
-    body = encoded_span
-
-    app.logger.debug("body %s", body)
-
-    return requests.post(
-        f"{ZIPKIN_URL}/api/v2/spans",
-        data=body,
-        headers={'Content-Type': 'application/json'},
-    )
+reporter = span_reporter(ZIPKIN_URL)
 
 
 @app.before_request
@@ -36,12 +26,6 @@ def log_request_info():
     app.logger.debug('Headers: %s', request.headers)
     app.logger.debug('Body: %s', request.get_data())
 
-@zipkin_client_span(service_name='service_03', span_name='call_service_03_from_service_02')
-def call_service_03():
-    headers = create_http_headers()
-    requests.get(f'http://{address}:8000/service-03', headers=headers)
-    return 'OK'
-
 
 @app.route('/')
 def index():
@@ -55,12 +39,14 @@ def index():
             is_sampled=request.headers['X-B3-Sampled'],
         ),
         span_name='index_service_02',
-        transport_handler=default_handler,
+        transport_handler=reporter,
         port=5000,
         sample_rate=100,
         encoding=Encoding.V2_JSON
     ):
-        call_service_03()
+        fan_out([
+            ('service_03', 'call_service_03_from_service_02', f'http://{address}:8000/service-03'),
+        ])
     return 'OK', 200
 
 
@@ -1,12 +1,11 @@
 import sys
 import time
-import requests
 import dotenv
 import os
 from flask import Flask, request
 from py_zipkin.zipkin import zipkin_span, create_http_headers_for_new_span, ZipkinAttrs, Kind, zipkin_client_span
-from py_zipkin.request_helpers import create_http_headers
 from py_zipkin.encoding import Encoding
+from common import span_reporter
 
 dotenv.load_dotenv()
 
@@ -19,16 +18,7 @@ ZIPKIN_URL = f'http://{address}:9411'
 
 app = Flask(__name__)
 
-def default_handler(encoded_span):
-    body = encoded_span
-
-    app.logger.debug("body %s", body)
-
-    return requests.post(
-        f"{ZIPKIN_URL}/api/v2/spans",
-        data=body,
-        headers={'Content-Type': 'application/json'},
-    )
+reporter = span_reporter(ZIPKIN_URL)
 
 
 @app.before_request
@@ -53,7 +43,7 @@ def index():
             is_sampled=request.headers['X-B3-Sampled'],
         ),
         span_name='index_service_03',
-        transport_handler=default_handler,
+        transport_handler=reporter,
         port=5000,
         sample_rate=100,
         encoding=Encoding.V2_JSON
@@ -0,0 +1,274 @@
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor
+
+PERCENTILES = [25, 50, 75, 80, 85, 90, 99]
+
+STATS_AGGS = {
+    "latency_stats": {"stats": {"field": "latencies.request"}},
+    "request_size_stats": {"stats": {"field": "request.size"}},
+    "response_size_stats": {"stats": {"field": "response.size"}},
+}
+
+# Estimated per bucket with a t-digest, so the cost does not grow with the
+# number of requests in the hour
+PERCENTILE_AGGS = {
+    "latency_percentiles": {
+        "percentiles": {
+            "field": "latencies.request",
+            "percents": PERCENTILES,
+            "tdigest": {"compression": 100},
+        }
+    },
+}
+
+HOURLY_AGGS = {**STATS_AGGS, **PERCENTILE_AGGS}
+
+TERMS_SIZE = 10000
+COMPOSITE_PAGE_SIZE = 1000
+
+
+def enrich(record):
+    _ts = datetime.fromisoformat(record["key_as_string"])
+    _output = {}
+    _output["ts"] = record["key"]
+    _output["ts_iso"] = record["key_as_string"]
+    _output["dow"] = _ts.isoweekday()
+    _output["weekend"] = _ts.isoweekday() in [6, 7]
+    _output["occurences"] = record["doc_count"]
+    for key in record:
+        if key in PERCENTILE_AGGS:
+            _output[key] = percentile_values(record[key])
+        elif key not in ["key", "key_as_string", "doc_count"]:
+            _output[key] = record[key]
+    return _output
+
+
+def percentile_key(percent):
+    return f"p{float(percent):g}".replace(".", "_")
+
+
+# {"values": {"50.0": ...}} -> {"p50": ...}, so that the flattened column
+# names ("latency_percentiles.p50") have no extra dots
+def percentile_values(aggregation):
+    return {
+        percentile_key(percent): value
+        for percent, value in aggregation["values"].items()
+    }
+
+
+def since_filter(since):
+    return {"range": {"@timestamp": {"gte": since, "format": "epoch_millis"}}}
+
+
+# Original engine: a Painless runtime field truncates every matching document's
+# timestamp to the hour and a terms aggregation groups on it. The bucket count
+# is capped at TERMS_SIZE, i.e. roughly 416 days of history.
+def terms_search(service_id, since=None):
+    _query = {"bool": {"must": {"match": {"service.id": service_id}}}}
+    if since is not None:
+        _query["bool"]["filter"] = since_filter(since)
+    _runtime_mappings = {
+        "hour_truncated_time": {
+            "type": "date",
+            "script": """
+                    ZonedDateTime truncatedDateTime = doc['@timestamp'].value.truncatedTo(ChronoUnit.HOURS);
+                    long miliTimestamp = truncatedDateTime.toEpochSecond() * 1000;
+                    emit(miliTimestamp);
+                """,
+        },
+    }
+    _aggs = {
+        "aggs": {
+            "terms": {
+                "size": TERMS_SIZE,
+                "field": "hour_truncated_time",
+                "order": {"_key": "desc"},
+            },
+            "aggs": HOURLY_AGGS,
+        },
+    }
+    return {
+        "query": _query,
+        "runtime_mappings": _runtime_mappings,
+        "fields": ["hour_truncated_time"],
+        "size": 0,
+        "aggs": _aggs,
+    }
+
+
+def terms_buckets(response):
+    return response["aggregations"]["aggs"]["buckets"], None
+
+
+# Native engine: a calendar-hour date_histogram source inside a composite
+# aggregation, paged with `after` so there is no bucket cap. The service clause
+# runs in filter context, so no scores are computed.
+def composite_search(service_id, since=None, after=None, page_size=COMPOSITE_PAGE_SIZE):
+    _filter = [{"match": {"service.id": service_id}}]
+    if since is not None:
+        _filter.append(since_filter(since))
+    _composite = {
+        "size": page_size,
+        "sources": [
+            {
+                "hour": {
+                    "date_histogram": {
+                        "field": "@timestamp",
+                        "calendar_interval": "1h",
+                        "order": "desc",
+                    }
+                }
+            }
+        ],
+    }
+    if after is not None:
+        _composite["after"] = after
+    return {
+        "query": {"bool": {"filter": _filter}},
+        "size": 0,
+        "aggs": {"aggs": {"composite": _composite, "aggs": HOURLY_AGGS}},
+    }
+
+
+def to_iso(ts):
+    return (
+        datetime.fromtimestamp(ts / 1000, tz=timezone.utc)
+        .strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3]
+        + "Z"
+    )
+
+
+# Reshape composite buckets like terms buckets so that enrich() is unchanged
+def composite_buckets(response, page_size=COMPOSITE_PAGE_SIZE):
+    aggregation = response["aggregations"]["aggs"]
+    buckets = []
+    for bucket in aggregation["buckets"]:
+        record = {key: bucket[key] for key in bucket if key != "key"}
+        record["key"] = bucket["key"]["hour"]
+        record["key_as_string"] = to_iso(bucket["key"]["hour"])
+        buckets.append(record)
+    after_key = aggregation.get("after_key")
+    if len(buckets) < page_size:
+        after_key = None
+    return buckets, after_key
+
+
+# Rollup engine: the hourly documents written by services/rollup (one per
+# service and hour, already shaped like a bucket), read newest first with
+# search_after. Nothing is aggregated at query time, and the sketches the
+# rollup service keeps for itself are left out.
+def rollup_search(service_id, since=None, after=None, page_size=COMPOSITE_PAGE_SIZE):
+    _filter = [{"term": {"service_id": service_id}}]
+    if since is not None:
+        _filter.append(since_filter(since))
+    _body = {
+        "query": {"bool": {"filter": _filter}},
+        "size": page_size,
+        "sort": [{"@timestamp": "desc"}],
+        "_source": {"excludes": ["service_id", "latency_sketch"]},
+    }
+    if after is not None:
+        _body["search_after"] = after
+    return _body
+
+
+def rollup_buckets(response, page_size=COMPOSITE_PAGE_SIZE):
+    hits = response["hits"]["hits"]
+    buckets = []
+    for hit in hits:
+        record = dict(hit["_source"])
+        record["key"] = record.pop("@timestamp")
+        record["key_as_string"] = to_iso(record["key"])
+        buckets.append(record)
+    after_key = hits[-1]["sort"] if len(hits) == page_size else None
+    return buckets, after_key
+
+
+ENGINES = {
+    "terms": (terms_search, terms_buckets),
+    "composite": (composite_search, composite_buckets),
+    "rollup": (rollup_search, rollup_buckets),
+}
+
+
+# `on_took(service_id, took_ms)` is called with the server-side time of every
+# search that is sent
+def fetch_buckets(client, index, engine, service_id, since=None, on_took=None):
+    search, parse = ENGINES[engine]
+    buckets = []
+    after_key = None
+    while True:
+        if after_key is None:
+            body = search(service_id, since)
+        else:
+            body = search(service_id, since, after=after_key)
+        response = client.search(index=index, **body).body
+        if on_took is not None:
+            on_took(service_id, response["took"])
+        page, after_key = parse(response)
+        buckets.extend(page)
+        if after_key is None:
+            return buckets
+
+
+# One msearch per round trip for a whole batch of services. Services whose
+# composite aggregation has more pages stay in the batch for the next round.
+def fetch_batch(client, index, engine, watermarks, on_took=None):
+    search, parse = ENGINES[engine]
+    results = {service_id: [] for service_id in watermarks}
+    errors = {}
+    pending = {service_id: None for service_id in watermarks}
+    while pending:
+        searches = []
+        for service_id, after_key in pending.items():
+            searches.append({"index": index})
+            if after_key is None:
+                searches.append(search(service_id, watermarks[service_id]))
+            else:
+                searches.append(
+                    search(service_id, watermarks[service_id], after=after_key)
+                )
+        responses = client.msearch(searches=searches).body["responses"]
+
+        next_pending = {}
+        for service_id, response in zip(pending, responses):
+            if "error" in response:
+                errors[service_id] = response["error"]
+                results.pop(service_id, None)
+                continue
+            if on_took is not None:
+                on_took(service_id, response["took"])
+            page, after_key = parse(response)
+            results[service_id].extend(page)
+            if after_key is not None:
+                next_pending[service_id] = after_key
+        pending = next_pending
+    return results, errors
+
+
+def fetch_services(
+    client, index, engine, watermarks, batch_size, concurrency, on_took=None
+):
+    service_ids = list(watermarks)
+    batches = [
+        {
+            service_id: watermarks[service_id]
+            for service_id in service_ids[idx : idx + batch_size]
+        }
+        for idx in range(0, len(service_ids), batch_size)
+    ]
+
+    # A transport error only fails the services of its own batch
+    def fetch(batch):
+        try:
+            return fetch_batch(client, index, engine, batch, on_took)
+        except Exception as err:
+            return {}, {service_id: err for service_id in batch}
+
+    results = {}
+    errors = {}
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for _results, _errors in executor.map(fetch, batches):
+            results.update(_results)
+            errors.update(_errors)
+    return results, errors
@@ -0,0 +1,132 @@
+import os
+import json
+import typing as T
+import numpy as np
+import pandas as pd
+
+
+# An artifact is a small metadata dict plus one table of rows. Stage 1 keeps
+# {"id", "name"} as metadata and the hourly buckets as rows, stage 2 keeps
+# {"metrics", "predict_range", "ts_unit"} and the forecast rows. Nested record
+# fields are flattened into dotted column names (e.g. "latency_stats.avg").
+class Artifact(T.NamedTuple):
+    meta: T.Dict
+    frame: T.Optional[pd.DataFrame]
+
+
+# Nullable numeric fields (e.g. percentiles of an empty bucket) come out of
+# json_normalize as object columns holding None. They are turned into floats
+# with NaN, so only real text columns such as "ts_iso" stay object.
+def numeric_columns(frame: pd.DataFrame) -> pd.DataFrame:
+    converted = {}
+    for column in frame.columns:
+        if frame[column].dtype != object:
+            continue
+        values = pd.to_numeric(frame[column], errors="coerce")
+        if values.notna().sum() == frame[column].notna().sum():
+            converted[column] = values.astype(np.float64)
+    return frame.assign(**converted) if converted else frame
+
+
+def to_frame(records) -> pd.DataFrame:
+    return numeric_columns(pd.json_normalize(records, sep="."))
+
+
+def to_records(frame: pd.DataFrame):
+    records = frame.astype(object).where(frame.notna(), None).to_dict(orient="records")
+    nested = [column for column in frame.columns if "." in column]
+    if not nested:
+        return records
+    for record in records:
+        for column in nested:
+            parent, child = column.split(".", 1)
+            record.setdefault(parent, {})[child] = record.pop(column)
+    return records
+
+
+# Artifact in the shape described by schema.py, with rows as records
+def to_output(artifact: Artifact) -> dict:
+    output = dict(artifact.meta)
+    if artifact.frame is not None and len(artifact.frame.columns):
+        output["data"] = to_records(artifact.frame)
+    return output
+
+
+class NpzFormat:
+    # One uncompressed .npy member per column, so loading a column is a plain
+    # buffer read with no parsing
+    suffix = "npz"
+
+    def write(self, path: str, meta: dict, frame):
+        arrays = {}
+        columns = []
+        if frame is not None:
+            frame = numeric_columns(frame)
+            columns = list(frame.columns)
+            for column in columns:
+                values = frame[column].to_numpy()
+                if values.dtype == object:
+                    values = values.astype(str)
+                arrays[column] = values
+        arrays["__meta__"] = np.array(json.dumps({"meta": meta, "columns": columns}))
+        with open(path, "wb") as file:
+            np.savez(file, **arrays)
+
+    def read(self, path: str):
+        with np.load(path, allow_pickle=False) as archive:
+            header = json.loads(str(archive["__meta__"]))
+            frame = pd.DataFrame({column: archive[column] for column in header["columns"]})
+        return Artifact(header["meta"], frame)
+
+
+class JsonFormat:
+    # The original layout: metadata and a "data" list of records in one document
+    suffix = "json"
+
+    def write(self, path: str, meta: dict, frame):
+        output = dict(meta)
+        if frame is not None:
+            output["data"] = to_records(frame)
+        with open(path, "w") as file:
+            json.dump(output, file, indent=None)
+
+    def read(self, path: str):
+        with open(path, "r") as file:
+            meta = json.load(file)
+        return Artifact(meta, to_frame(meta.pop("data", [])))
+
+
+FORMATS = {
+    "npz": NpzFormat(),
+    "json": JsonFormat(),
+}
+
+
+class ArtifactStore:
+    def __init__(self, root: str, format: str = "npz", exports=()):
+        assert format in FORMATS
+        assert all(export in ["json", "csv"] for export in exports)
+        self.root = root
+        self.format = FORMATS[format]
+        self.exports = exports
+
+    def path(self, service_id: str, stage: str, suffix: str = None) -> str:
+        suffix = suffix or self.format.suffix
+        return f"{self.root}/{service_id}/new_metrics/{stage}.{suffix}"
+
+    def save(self, service_id: str, stage: str, meta: dict, frame=None):
+        os.makedirs(f"{self.root}/{service_id}/new_metrics", exist_ok=True)
+        path = self.path(service_id, stage)
+        self.format.write(f"{path}.tmp", meta, frame)
+        os.replace(f"{path}.tmp", path)
+
+        if "json" in self.exports and self.format.suffix != "json":
+            FORMATS["json"].write(self.path(service_id, stage, "json"), meta, frame)
+        if "csv" in self.exports and frame is not None:
+            frame.to_csv(self.path(service_id, stage, "csv"), header=True, index=False)
+
+    def load(self, service_id: str, stage: str) -> Artifact:
+        return self.format.read(self.path(service_id, stage))
+
+    def load_output(self, service_id: str, stage: str) -> dict:
+        return to_output(self.load(service_id, stage))
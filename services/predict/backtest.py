@@ -0,0 +1,288 @@
+# Rolling-origin backtest of the stage_2 engines on the stored stage-1
+# histories. For every service, `folds` forecast origins are placed `step`
+# hours apart, ending so that the last test window reaches the newest bucket.
+# At each origin a model is fitted only on the buckets before it (all of them,
+# or the last `window` hours) and scored on the buckets after it, per lead-time
+# bucket: (0, h1], (h1, h2], ... hours for --horizons h1,h2,...
+#
+# Every (service, model) pair is a task on a process pool. The histories of all
+# services are written once as two .npy files that the workers map read-only,
+# so tasks only carry offsets into them.
+#
+# The summary has one row per model and horizon: MAE and RMSE averaged over
+# services, the median of MAE relative to a seasonal naive forecast (same hour
+# one week earlier, 1 = no better than naive), and fit/predict CPU seconds.
+#
+# Run from services/predict (or /app in the worker container):
+#   python backtest.py --models linear,random_forest_bounded,sgd --output backtest.csv
+#   python backtest.py --recommend service_models.json  # for PREDICT_SERVICE_MODELS
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import numpy as np
+import pandas as pd
+import artifacts
+import features
+import models
+
+DATA_DIR = "output"
+ARTIFACT_FORMAT = os.environ.get("ARTIFACT_FORMAT", "npz")
+PREDICT_MODELS = os.environ.get("PREDICT_MODELS", '["random_forest", "linear"]')
+
+PREDICT_MODELS = json.loads(PREDICT_MODELS)
+
+HOUR_MS = features.HOUR_MS
+NAIVE = "seasonal_naive"
+SEASON_MS = 7 * features.DAY_MS
+# Folds with fewer training buckets are skipped
+MIN_TRAIN = 48
+
+# Histories mapped by the worker process, see attach()
+_shared = {}
+
+
+def load_histories(service_ids):
+    store = artifacts.ArtifactStore(DATA_DIR, format=ARTIFACT_FORMAT)
+    histories = {}
+    for service_id in service_ids:
+        try:
+            _, frame = store.load(service_id, "stage-1")
+        except (OSError, ValueError, KeyError):
+            continue
+        if frame is None or not features.has_targets(frame):
+            continue
+        X, Y = features.history_columns(frame)
+        # Oldest first, and only buckets with every target
+        order = np.argsort(X[:, 0], kind="stable")
+        X, Y = X[order], Y[order]
+        complete = np.isfinite(Y).all(axis=1)
+        histories[service_id] = (X[complete], Y[complete])
+    return histories
+
+
+def share(histories, directory):
+    X = np.concatenate([X for X, _ in histories.values()])
+    Y = np.concatenate([Y for _, Y in histories.values()])
+    np.save(f"{directory}/X.npy", X)
+    np.save(f"{directory}/Y.npy", Y)
+    offsets = {}
+    start = 0
+    for service_id, (X, _) in histories.items():
+        offsets[service_id] = (start, start + len(X))
+        start += len(X)
+    return offsets
+
+
+def attach(directory):
+    # Pages are shared with every other worker through the page cache
+    _shared["X"] = np.load(f"{directory}/X.npy", mmap_mode="r")
+    _shared["Y"] = np.load(f"{directory}/Y.npy", mmap_mode="r")
+    # One core per worker; the pool provides the parallelism
+    try:
+        from threadpoolctl import threadpool_limits
+
+        threadpool_limits(1)
+    except ImportError:
+        pass
+
+
+def origins(ts, folds, step_ms, horizon_ms):
+    last = ts[-1] + HOUR_MS - horizon_ms
+    return [last - fold * step_ms for fold in range(folds)]
+
+
+def naive_predict(train_ts, train_Y, test_ts):
+    # Same hour one week earlier, else the last value before the origin
+    positions = np.searchsorted(train_ts, test_ts - SEASON_MS)
+    found = positions < len(train_ts)
+    found[found] = train_ts[positions[found]] == test_ts[found] - SEASON_MS
+    predicted = np.repeat(train_Y[-1:], len(test_ts), axis=0)
+    predicted[found] = train_Y[positions[found]]
+    return predicted
+
+
+def fit_predict(name, train_X, train_Y, test_X):
+    engine = models.ENGINES[name]
+    params = dict(engine.params)
+    if "n_jobs" in params:
+        params["n_jobs"] = 1
+    started = time.process_time()
+    model = engine.factory(**params).fit(train_X, train_Y)
+    fitted = time.process_time()
+    predicted = np.asarray(model.predict(test_X)).reshape(len(test_X), -1)
+    return predicted, fitted - started, time.process_time() - fitted
+
+
+# Errors of one model on one service, summed per horizon bucket and target
+def evaluate(task):
+    service_id, (start, stop), name, options = task
+    X = _shared["X"][start:stop]
+    Y = _shared["Y"][start:stop]
+    ts = X[:, 0]
+    horizons_ms = np.array(options["horizons"], dtype=np.float64) * HOUR_MS
+    targets = len(features.TARGETS)
+    abs_error = np.zeros((len(horizons_ms), targets))
+    sq_error = np.zeros((len(horizons_ms), targets))
+    counts = np.zeros(len(horizons_ms), dtype=np.int64)
+    fit_s = predict_s = 0.0
+    fits = 0
+    for origin in origins(ts, options["folds"], options["step_h"] * HOUR_MS, horizons_ms[-1]):
+        train = ts < origin
+        if options["window_h"]:
+            train &= ts >= origin - options["window_h"] * HOUR_MS
+        test = (ts >= origin) & (ts < origin + horizons_ms[-1])
+        if train.sum() < MIN_TRAIN or not test.any():
+            continue
+        if name == NAIVE:
+            predicted = naive_predict(ts[train], Y[train], ts[test])
+        else:
+            predicted, fit, predict = fit_predict(name, X[train], Y[train], X[test])
+            fit_s += fit
+            predict_s += predict
+        fits += 1
+        # Bucket i holds the leads in [h(i-1), h(i)) ms, i.e. hours h(i-1)+1..h(i) ahead
+        buckets = np.searchsorted(horizons_ms, ts[test] - origin, side="right")
+        errors = predicted - Y[test]
+        np.add.at(abs_error, buckets, np.abs(errors))
+        np.add.at(sq_error, buckets, errors**2)
+        np.add.at(counts, buckets, 1)
+    return {
+        "service_id": service_id,
+        "model": name,
+        "abs_error": abs_error,
+        "sq_error": sq_error,
+        "counts": counts,
+        "fits": fits,
+        "fit_s": fit_s,
+        "predict_s": predict_s,
+    }
+
+
+def details(results, horizons):
+    rows = []
+    for result in results:
+        for idx, horizon in enumerate(horizons):
+            count = result["counts"][idx]
+            if not count:
+                continue
+            for target_idx, target in enumerate(features.TARGETS):
+                rows.append(
+                    {
+                        "service_id": result["service_id"],
+                        "model": result["model"],
+                        "horizon_h": horizon,
+                        "target": target,
+                        "mae": result["abs_error"][idx, target_idx] / count,
+                        "rmse": np.sqrt(result["sq_error"][idx, target_idx] / count),
+                        "points": int(count),
+                        "fits": result["fits"],
+                        "fit_s": result["fit_s"] / max(result["fits"], 1),
+                        "predict_s": result["predict_s"] / max(result["fits"], 1),
+                    }
+                )
+    frame = pd.DataFrame(rows)
+    naive = frame[frame["model"] == NAIVE].set_index(["service_id", "horizon_h", "target"])["mae"]
+    frame["rel_mae"] = frame["mae"].to_numpy() / naive.reindex(
+        pd.MultiIndex.from_frame(frame[["service_id", "horizon_h", "target"]])
+    ).to_numpy()
+    return frame
+
+
+def summary(frame, target):
+    selected = frame[frame["target"] == target]
+    return (
+        selected.groupby(["model", "horizon_h"])
+        .agg(
+            services=("service_id", "nunique"),
+            mae=("mae", "mean"),
+            rmse=("rmse", "mean"),
+            rel_mae=("rel_mae", "median"),
+            fit_s=("fit_s", "mean"),
+            predict_s=("predict_s", "mean"),
+        )
+        .reset_index()
+        .sort_values(["horizon_h", "rel_mae"])
+    )
+
+
+# Per service, the model with the lowest MAE relative to naive, averaged over
+# horizons
+def recommend(frame, target):
+    selected = frame[(frame["target"] == target) & (frame["model"] != NAIVE)]
+    ranked = selected.groupby(["service_id", "model"])["rel_mae"].mean().reset_index()
+    best = ranked.loc[ranked.groupby("service_id")["rel_mae"].idxmin()]
+    return {row.service_id: [row.model] for row in best.itertuples()}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--models", default=",".join(PREDICT_MODELS))
+    parser.add_argument("--services", help="comma-separated ids, default all")
+    parser.add_argument("--horizons", default="1,24,168")
+    parser.add_argument("--folds", type=int, default=4)
+    parser.add_argument("--step", type=int, default=24, help="hours between origins")
+    parser.add_argument("--window", type=int, default=0, help="training hours, 0 = expanding")
+    parser.add_argument("--target", default="latency", choices=list(features.TARGETS))
+    parser.add_argument("--processes", type=int, default=os.cpu_count())
+    parser.add_argument("--output", help="summary table as CSV")
+    parser.add_argument("--details", help="per-service rows as CSV")
+    parser.add_argument("--recommend", help="best model per service as JSON")
+    args = parser.parse_args()
+
+    names = [name for name in args.models.split(",") if name]
+    assert all(name in models.ENGINES for name in names)
+    horizons = sorted(int(horizon) for horizon in args.horizons.split(","))
+    service_ids = args.services.split(",") if args.services else sorted(os.listdir(DATA_DIR))
+
+    histories = load_histories(service_ids)
+    if not histories:
+        raise SystemExit(f"no stage-1 histories in {DATA_DIR}")
+    options = {
+        "horizons": horizons,
+        "folds": args.folds,
+        "step_h": args.step,
+        "window_h": args.window,
+    }
+
+    started = time.perf_counter()
+    with tempfile.TemporaryDirectory(prefix="backtest-") as directory:
+        offsets = share(histories, directory)
+        tasks = [
+            (service_id, offsets[service_id], name, options)
+            for service_id in offsets
+            for name in [NAIVE, *names]
+        ]
+        # Spawned, so no worker inherits the parent's BLAS or OpenMP threads
+        with ProcessPoolExecutor(
+            max_workers=args.processes,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=attach,
+            initargs=(directory,),
+        ) as executor:
+            results = list(executor.map(evaluate, tasks, chunksize=4))
+    elapsed = time.perf_counter() - started
+
+    frame = details(results, horizons)
+    table = summary(frame, args.target)
+    print(table.to_string(index=False, float_format=lambda value: f"{value:.4g}"))
+    print(
+        len(histories), "services,", len(tasks), "tasks in", f"{elapsed:.1f}s",
+        "on", args.processes, "processes",
+        file=sys.stderr,
+    )
+    if args.output:
+        table.to_csv(args.output, index=False)
+    if args.details:
+        frame.to_csv(args.details, index=False)
+    if args.recommend:
+        with open(args.recommend, "w") as file:
+            json.dump(recommend(frame, args.target), file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
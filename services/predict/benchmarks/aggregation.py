@@ -0,0 +1,118 @@
+# Side-by-side benchmark of the stage_1 aggregation engines on a synthetic index.
+#
+# Run from services/predict against a disposable Elasticsearch:
+#   ELASTICSEARCH_CONFIG='{"hosts": "http://localhost:9200"}' \
+#   python -m benchmarks.aggregation --services 5 --hours 2400 --docs-per-hour 20
+import os
+import json
+import time
+import random
+import argparse
+from elasticsearch import Elasticsearch, helpers
+import aggregation
+
+HOUR_MS = 3600 * 1000
+
+
+def generate_docs(index, services, hours, docs_per_hour, now_ms):
+    start_ms = now_ms - hours * HOUR_MS
+    for service_id in services:
+        for hour in range(hours):
+            for _ in range(random.randint(0, docs_per_hour)):
+                ts = start_ms + hour * HOUR_MS + random.randrange(HOUR_MS)
+                yield {
+                    "_index": index,
+                    "_source": {
+                        "@timestamp": ts,
+                        "service": {"id": service_id},
+                        "latencies": {"request": random.randint(1, 2000)},
+                        "request": {"size": random.randint(100, 1000)},
+                        "response": {"size": random.randint(100, 5000)},
+                    },
+                }
+
+
+def build_index(client, index, services, hours, docs_per_hour):
+    client.options(ignore_status=404).indices.delete(index=index)
+    client.indices.create(
+        index=index,
+        mappings={
+            "properties": {
+                "@timestamp": {"type": "date", "format": "epoch_millis"},
+                "service": {"properties": {"id": {"type": "keyword"}}},
+            }
+        },
+    )
+    now_ms = int(time.time() * 1000)
+    indexed, _ = helpers.bulk(
+        client, generate_docs(index, services, hours, docs_per_hour, now_ms)
+    )
+    client.indices.refresh(index=index)
+    return indexed
+
+
+def run_engine(client, index, engine, services, repeats):
+    timings = []
+    records = {}
+    for _ in range(repeats):
+        started = time.perf_counter()
+        for service_id in services:
+            buckets = aggregation.fetch_buckets(client, index, engine, service_id)
+            records[service_id] = [aggregation.enrich(bucket) for bucket in buckets]
+        timings.append(time.perf_counter() - started)
+    return timings, records
+
+
+def same_records(left, right):
+    if len(left) != len(right):
+        return False
+    for a, b in zip(left, right):
+        if a["ts"] != b["ts"] or a["occurences"] != b["occurences"]:
+            return False
+        for key in aggregation.STATS_AGGS:
+            for stat in a[key]:
+                if a[key][stat] != b[key][stat] and abs(a[key][stat] - b[key][stat]) > 1e-6:
+                    return False
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--index", default="bench-kong-log")
+    parser.add_argument("--services", type=int, default=5)
+    parser.add_argument("--hours", type=int, default=24 * 100)
+    parser.add_argument("--docs-per-hour", type=int, default=20)
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--keep-index", action="store_true")
+    args = parser.parse_args()
+
+    client = Elasticsearch(**json.loads(os.environ.get("ELASTICSEARCH_CONFIG", "{}")))
+    services = [f"bench-service-{idx:04d}" for idx in range(args.services)]
+    indexed = build_index(
+        client, args.index, services, args.hours, args.docs_per_hour
+    )
+
+    results = {"documents": indexed, "services": args.services, "hours": args.hours}
+    outputs = {}
+    # "rollup" reads the rollup index, which this raw-log fixture does not have
+    for engine in ("terms", "composite"):
+        timings, outputs[engine] = run_engine(
+            client, args.index, engine, services, args.repeats
+        )
+        results[engine] = {
+            "best_s": min(timings),
+            "mean_s": sum(timings) / len(timings),
+            "buckets": sum(len(outputs[engine][s]) for s in services),
+        }
+    results["identical"] = all(
+        same_records(outputs["terms"][s], outputs["composite"][s]) for s in services
+    )
+    results["speedup"] = results["terms"]["best_s"] / results["composite"]["best_s"]
+    print(json.dumps(results, indent=2))
+
+    if not args.keep_index:
+        client.indices.delete(index=args.index)
+
+
+if __name__ == "__main__":
+    main()
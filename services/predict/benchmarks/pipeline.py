@@ -0,0 +1,179 @@
+# End-to-end benchmark of the predict pipeline on synthetic data, with
+# Elasticsearch and Postgres replaced by the stand-ins in synthetic.py.
+#
+# Every scale runs in its own process and scratch directory, so peak RSS is
+# per scale. Per scale it times stage_1, stage_2 and stage_3 on an empty output
+# directory, then the full run_pipeline cold (empty output again) and warm
+# (right after, i.e. incremental fetch and cached models, as on the one-minute
+# schedule). The pipeline's own settings (PREDICT_MODELS, FETCH_MODE, ...) are
+# taken from the environment as usual.
+#
+# Run from services/predict:
+#   python -m benchmarks.pipeline --scales 10,100,1000 --days 30 --output bench.json
+#   python -m benchmarks.pipeline --scales 10,100 --baseline bench.json
+#
+# Exits with 1 when a warm run exceeds --budget seconds or a phase is more than
+# --tolerance slower than in --baseline.
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+DEFAULT_ENV = {
+    "REDIS_URL": "memory://",
+    "ELASTICSEARCH_INDEX": "kong-log",
+    "ELASTICSEARCH_CONFIG": '{"hosts": "http://localhost:9200"}',
+    "POSTGRES_CONFIG": '{"user": "bench", "password": "bench", "host": "localhost", "port": "5432"}',
+}
+
+PHASES = ["stage_1", "stage_2", "stage_3", "run_pipeline_cold", "run_pipeline_warm"]
+
+
+def run_scale(args):
+    for key, value in DEFAULT_ENV.items():
+        os.environ.setdefault(key, value)
+    import app  # noqa: F401 - configures the Celery app for the fanout mode
+    import utils
+    import tasks
+    from instrumentation import peak_rss_bytes
+    from registry import ServiceRegistry
+    from benchmarks.synthetic import SyntheticLogs, FakeElasticsearch, SyntheticServices
+
+    logs = SyntheticLogs(
+        args.run_scale, args.days * 24, gap_rate=args.gap_rate, noise=args.noise, seed=args.seed
+    )
+    client = FakeElasticsearch(logs)
+    utils.REGISTRY = ServiceRegistry([SyntheticServices(logs)], ttl=utils.REGISTRY.ttl)
+    utils.get_es_client = lambda: client
+
+    result = {"services": args.run_scale, "hours": args.days * 24, "phases": {}}
+
+    def measure(name, func):
+        stand_in = client.time_s
+        started = time.perf_counter()
+        output = func()
+        result["phases"][name] = {
+            "wall_s": time.perf_counter() - started,
+            "stand_in_s": client.time_s - stand_in,
+            "peak_rss_bytes": peak_rss_bytes(),
+        }
+        return output
+
+    def reset():
+        utils._histories.clear()
+        shutil.rmtree(utils.DATA_DIR, ignore_errors=True)
+
+    checkpoint = utils.PIPELINE_CHECKPOINT
+    stage_1 = measure("stage_1", lambda: utils.stage_1(checkpoint=checkpoint))
+    stage_2 = measure("stage_2", lambda: utils.stage_2(stage_1, checkpoint=checkpoint))
+    measure("stage_3", lambda: utils.stage_3(stage_2, checkpoint=checkpoint))
+    reset()
+    measure("run_pipeline_cold", tasks.run_pipeline)
+    measure("run_pipeline_warm", tasks.run_pipeline)
+
+    result["stand_in"] = client.counters
+    result["model_cache"] = utils.MODEL_CACHE.stats()
+    result["registry"] = utils.REGISTRY.stats()
+    with open(args.result, "w") as file:
+        json.dump(result, file)
+
+
+def compare(results, baseline, tolerance):
+    previous = {result["services"]: result for result in baseline["results"]}
+    regressions = []
+    for result in results:
+        if result["services"] not in previous:
+            continue
+        for phase, timing in result["phases"].items():
+            before = previous[result["services"]]["phases"].get(phase)
+            if before and timing["wall_s"] > before["wall_s"] * (1 + tolerance):
+                regressions.append(
+                    {
+                        "services": result["services"],
+                        "phase": phase,
+                        "wall_s": timing["wall_s"],
+                        "baseline_wall_s": before["wall_s"],
+                    }
+                )
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--scales", default="10,100,1000")
+    parser.add_argument("--days", type=int, default=30)
+    parser.add_argument("--gap-rate", type=float, default=0.05)
+    parser.add_argument("--noise", type=float, default=0.2)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--budget", type=float, default=60)
+    parser.add_argument("--baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    parser.add_argument("--output")
+    # Internal: run a single scale in this process
+    parser.add_argument("--run-scale", type=int)
+    parser.add_argument("--result")
+    args = parser.parse_args()
+
+    if args.run_scale is not None:
+        return run_scale(args)
+
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = {**os.environ, "PYTHONPATH": os.pathsep.join(filter(None, [root, os.environ.get("PYTHONPATH")]))}
+    results = []
+    for scale in [int(scale) for scale in args.scales.split(",")]:
+        with tempfile.TemporaryDirectory(prefix="predict-bench-") as workdir:
+            result_path = os.path.join(workdir, "result.json")
+            command = [
+                sys.executable, "-m", "benchmarks.pipeline",
+                "--run-scale", str(scale),
+                "--days", str(args.days),
+                "--gap-rate", str(args.gap_rate),
+                "--noise", str(args.noise),
+                "--seed", str(args.seed),
+                "--result", result_path,
+            ]
+            # The pipeline prints a lot; keep it out of the report
+            with open(os.path.join(workdir, "pipeline.log"), "w") as log:
+                completed = subprocess.run(command, cwd=workdir, env=env, stdout=log, stderr=subprocess.STDOUT)
+            if completed.returncode != 0:
+                with open(os.path.join(workdir, "pipeline.log")) as log:
+                    print(log.read()[-4000:], file=sys.stderr)
+                raise SystemExit(f"benchmark at {scale} services failed")
+            with open(result_path) as file:
+                result = json.load(file)
+        result["within_budget"] = result["phases"]["run_pipeline_warm"]["wall_s"] <= args.budget
+        results.append(result)
+        print(
+            scale, "services:",
+            ", ".join(f"{phase} {result['phases'][phase]['wall_s']:.2f}s" for phase in PHASES),
+            file=sys.stderr,
+        )
+
+    report = {
+        "created": time.time(),
+        "budget_s": args.budget,
+        "settings": {
+            key: os.environ.get(key)
+            for key in ["PREDICT_MODELS", "FETCH_MODE", "AGGREGATION_ENGINE", "PIPELINE_MODE", "ARTIFACT_FORMAT"]
+            if os.environ.get(key)
+        },
+        "results": results,
+    }
+    if args.baseline:
+        with open(args.baseline) as file:
+            report["regressions"] = compare(results, json.load(file), args.tolerance)
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2)
+
+    failed = not all(result["within_budget"] for result in results) or report.get("regressions")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
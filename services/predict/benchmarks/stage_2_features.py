@@ -0,0 +1,136 @@
+# Micro-benchmark of the stage_2 forecast-frame construction: the former
+# row-by-row loop against the vectorized builder in features.py.
+#
+# Run from services/predict:
+#   python -m benchmarks.stage_2_features --services 20 --years 3
+import json
+import time
+import random
+import argparse
+import numpy as np
+import pandas as pd
+from datetime import datetime, timedelta
+import artifacts
+import features
+
+HOUR_MS = 3600 * 1000
+
+
+def synthetic_history(hours, now_ms):
+    start = now_ms - hours * HOUR_MS
+    data = []
+    for hour in range(hours, 0, -1):
+        if random.random() < 0.1:
+            continue
+        ts = start + hour * HOUR_MS
+        dow = datetime.utcfromtimestamp(ts / 1000).isoweekday()
+        data.append(
+            {
+                "ts": ts,
+                "dow": dow,
+                "weekend": dow in [6, 7],
+                "latency_stats": {"avg": random.random() * 100},
+            }
+        )
+    return data
+
+
+def legacy(data, end, predictions):
+    org_ts = {point["ts"]: idx for idx, point in enumerate(data)}
+    ext_date_range = pd.date_range(
+        datetime.utcfromtimestamp(data[-1]["ts"] / 1000), end, freq="h"
+    )
+    test_features = []
+    ext_samples = []
+    ext_features = []
+    for ext_date in ext_date_range:
+        _sample = (
+            ext_date.timestamp() * 1000,
+            ext_date.isoweekday(),
+            ext_date.isoweekday() in [6, 7],
+        )
+        _feature = None
+        if _sample[0] in org_ts:
+            _feature = data[org_ts[_sample[0]]]["latency_stats"]["avg"]
+            test_features.append(_feature)
+        ext_samples.append(_sample)
+        ext_features.append(_feature)
+    predicted = predictions[: len(ext_samples)]
+    pred_features = [
+        predicted[idx] for idx in range(len(ext_features)) if ext_features[idx] is not None
+    ]
+    _df_data = [
+        (
+            datetime.utcfromtimestamp(ext_samples[idx][0] / 1000).isoformat(),
+            *ext_samples[idx],
+            ext_features[idx],
+            predicted[idx],
+        )
+        for idx in range(len(ext_samples))
+    ]
+    return pd.DataFrame(
+        data=_df_data,
+        columns=["ts_iso", "ts", "dow", "weekend", "latency", "prediction"],
+    ), pred_features
+
+
+# Only the average is in the synthetic history
+TARGETS = {"latency": "latency_stats.avg"}
+
+
+def vectorized(data, end, predictions):
+    history_X, history_Y = features.history_columns(data, TARGETS)
+    data = history_X[:, 0]
+    df = features.forecast_frame(
+        data[-1], end.timestamp() * 1000, history_X[:, 0], history_Y, TARGETS
+    )
+    has_actual = df["latency"].notna().to_numpy()
+    predicted = predictions[: len(df)]
+    df.insert(0, "ts_iso", features.to_iso(df["ts"].to_numpy()))
+    df["prediction"] = predicted
+    return df, predicted[has_actual]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--services", type=int, default=20)
+    parser.add_argument("--years", type=float, default=3)
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    now_ms = int(time.time() // 3600) * HOUR_MS
+    end = datetime.utcfromtimestamp(now_ms / 1000) + timedelta(days=7)
+    hours = int(args.years * 365 * 24)
+    histories = [synthetic_history(hours, now_ms) for _ in range(args.services)]
+    predictions = np.random.random(hours + 24 * 8)
+
+    results = {"services": args.services, "hours": hours}
+    frames = {}
+    # The vectorized path reads stage-1 as a columnar frame (see artifacts.py)
+    inputs = {
+        "legacy": histories,
+        "vectorized": [artifacts.to_frame(data) for data in histories],
+    }
+    for name, build in [("legacy", legacy), ("vectorized", vectorized)]:
+        timings = []
+        for _ in range(args.repeats):
+            started = time.perf_counter()
+            frames[name] = [build(data, end, predictions) for data in inputs[name]]
+            timings.append(time.perf_counter() - started)
+        results[name] = {"best_s": min(timings), "mean_s": sum(timings) / len(timings)}
+
+    legacy_df, legacy_pred = frames["legacy"][0]
+    vector_df, vector_pred = frames["vectorized"][0]
+    results["identical"] = bool(
+        legacy_df["ts"].equals(vector_df["ts"])
+        and (legacy_df["dow"].to_numpy() == vector_df["dow"].to_numpy()).all()
+        and (legacy_df["weekend"].to_numpy() == vector_df["weekend"].to_numpy()).all()
+        and (legacy_df["ts_iso"].to_numpy() == vector_df["ts_iso"].to_numpy()).all()
+        and np.allclose(legacy_pred, vector_pred)
+    )
+    results["speedup"] = results["legacy"]["best_s"] / results["vectorized"]["best_s"]
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
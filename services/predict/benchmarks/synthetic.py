@@ -0,0 +1,242 @@
+# Offline stand-ins for what the pipeline talks to: hourly Kong-log
+# aggregations generated per service, an Elasticsearch client that answers the
+# stage_1 searches from them and accepts the stage_3 writes, and a service
+# registry source serving the `services` rows. Nothing goes over the network.
+import json
+import time
+import zlib
+import numpy as np
+from statistics import NormalDist
+from elasticsearch import Elasticsearch
+from elastic_transport import ApiResponseMeta, HttpHeaders, NodeConfig, ObjectApiResponse
+import aggregation
+
+HOUR_MS = 3600 * 1000
+
+
+class SyntheticLogs:
+    # Per service: a log-normal latency distribution whose median follows a
+    # daily and weekly cycle, `noise` as the relative spread of the hourly
+    # median, and a fraction `gap_rate` of hours without any traffic. Every
+    # service has its own seed, so histories do not depend on the scale.
+    def __init__(self, services, hours, gap_rate=0.05, noise=0.2, seed=0, now_ms=None):
+        self.service_ids = [f"svc-{idx:05d}" for idx in range(services)]
+        self._known = set(self.service_ids)
+        self.hours = hours
+        self.gap_rate = gap_rate
+        self.noise = noise
+        self.seed = seed
+        if now_ms is None:
+            now_ms = int(time.time() * 1000)
+        self.now_ms = now_ms // HOUR_MS * HOUR_MS
+        self._histories = {}
+
+    def rows(self):
+        return [(service_id, f"name-{service_id}", "synthetic") for service_id in self.service_ids]
+
+    def history(self, service_id):
+        if service_id in self._histories:
+            return self._histories[service_id]
+        rng = np.random.default_rng([self.seed, zlib.crc32(service_id.encode())])
+        # Newest first, like the composite aggregation returns them
+        ts = self.now_ms - np.arange(self.hours, dtype=np.int64) * HOUR_MS
+        kept = rng.random(self.hours) >= self.gap_rate
+        kept[0] = True
+        ts = ts[kept]
+
+        hour_of_day = (ts // HOUR_MS) % 24
+        day = (ts // (24 * HOUR_MS) + 3) % 7
+        base = rng.uniform(20, 400)
+        cycle = 1 + 0.3 * np.sin(2 * np.pi * hour_of_day / 24) + 0.2 * (day >= 5)
+        median = base * cycle * rng.lognormal(0, self.noise, len(ts))
+        sigma = rng.uniform(0.3, 0.9)
+        count = rng.poisson(rng.uniform(5, 500), len(ts)) + 1
+
+        percentiles = {
+            f"{percent:.1f}": median * np.exp(sigma * NormalDist().inv_cdf(percent / 100))
+            for percent in aggregation.PERCENTILES
+        }
+        history = {
+            "ts": ts,
+            "count": count,
+            "avg": median * np.exp(sigma**2 / 2),
+            "min": median * np.exp(-3 * sigma),
+            "max": median * np.exp(3 * sigma),
+            "percentiles": percentiles,
+            "request_size": rng.uniform(100, 1000, len(ts)),
+            "response_size": rng.uniform(100, 5000, len(ts)),
+        }
+        self._histories[service_id] = history
+        return history
+
+    # Buckets newer than or at `since`, older than `before`, newest first, in
+    # the shape of composite_buckets()/terms_buckets() input
+    def buckets(self, service_id, since=None, before=None, limit=None):
+        if service_id not in self._known:
+            return []
+        history = self.history(service_id)
+        ts = history["ts"]
+        selected = np.ones(len(ts), dtype=bool)
+        if since is not None:
+            selected &= ts >= since
+        if before is not None:
+            selected &= ts < before
+        positions = np.flatnonzero(selected)
+        if limit is not None:
+            positions = positions[:limit]
+        buckets = []
+        for idx in positions:
+            count = int(history["count"][idx])
+            buckets.append(
+                {
+                    "key": int(ts[idx]),
+                    "doc_count": count,
+                    "latency_stats": stats(count, history["min"][idx], history["max"][idx], history["avg"][idx]),
+                    "latency_percentiles": {
+                        "values": {
+                            percent: float(values[idx])
+                            for percent, values in history["percentiles"].items()
+                        }
+                    },
+                    "request_size_stats": stats(count, 100, 1000, history["request_size"][idx]),
+                    "response_size_stats": stats(count, 100, 5000, history["response_size"][idx]),
+                }
+            )
+        return buckets
+
+
+def stats(count, low, high, avg):
+    return {
+        "count": count,
+        "min": float(low),
+        "max": float(high),
+        "avg": float(avg),
+        "sum": float(avg) * count,
+    }
+
+
+def _response(body):
+    meta = ApiResponseMeta(
+        status=200,
+        http_version="1.1",
+        headers=HttpHeaders(),
+        duration=0,
+        node=NodeConfig("http", "localhost", 9200),
+    )
+    return ObjectApiResponse(body=body, meta=meta)
+
+
+class _Indices:
+    def __init__(self, client):
+        self.client = client
+
+    def create(self, index=None, **kwargs):
+        self.client.indices_created.add(index)
+        return _response({"acknowledged": True, "index": index})
+
+
+class FakeElasticsearch(Elasticsearch):
+    # Answers the searches built by aggregation.py (every engine, single and
+    # msearch) and acknowledges bulk, delete_by_query and index creation.
+    # `time_s` is the time spent in here, so it can be told apart from the
+    # pipeline's own work.
+    def __init__(self, logs: SyntheticLogs):
+        super().__init__("http://localhost:9200")
+        self.logs = logs
+        self.indices = _Indices(self)
+        self.indices_created = set()
+        self.counters = {"searches": 0, "msearches": 0, "bulk_requests": 0, "bulk_documents": 0, "deleted_by_query": 0}
+        self.time_s = 0.0
+
+    def options(self, **kwargs):
+        return self
+
+    def _answer(self, body):
+        query = body["query"]["bool"]
+        clauses = list(query.get("filter", []))
+        if isinstance(query.get("filter"), dict):
+            clauses = [query["filter"]]
+        if "must" in query:
+            clauses.append(query["must"])
+        service_id = None
+        since = None
+        for clause in clauses:
+            if "match" in clause:
+                service_id = clause["match"]["service.id"]
+            elif "term" in clause:
+                service_id = clause["term"]["service_id"]
+            elif "range" in clause:
+                since = clause["range"]["@timestamp"]["gte"]
+
+        if "aggs" not in body:
+            # Rollup documents
+            before = body.get("search_after", [None])[0]
+            page = self.logs.buckets(service_id, since, before, body["size"])
+            hits = [
+                {
+                    "_id": f"{service_id}:{bucket['key']}",
+                    "_source": {**{k: v for k, v in bucket.items() if k != "key"}, "@timestamp": bucket["key"]},
+                    "sort": [bucket["key"]],
+                }
+                for bucket in page
+            ]
+            return {"took": 1, "timed_out": False, "hits": {"hits": hits}}
+
+        aggs = body["aggs"]["aggs"]
+        if "composite" in aggs:
+            composite = aggs["composite"]
+            before = composite.get("after", {}).get("hour")
+            page = self.logs.buckets(service_id, since, before, composite["size"])
+            response = {"buckets": [dict(bucket, key={"hour": bucket["key"]}) for bucket in page]}
+            if page:
+                response["after_key"] = {"hour": page[-1]["key"]}
+        else:
+            page = self.logs.buckets(service_id, since, limit=aggs["terms"]["size"])
+            response = {
+                "buckets": [dict(bucket, key_as_string=aggregation.to_iso(bucket["key"])) for bucket in page]
+            }
+        return {"took": 1, "timed_out": False, "aggregations": {"aggs": response}}
+
+    def search(self, index=None, **body):
+        started = time.perf_counter()
+        self.counters["searches"] += 1
+        response = self._answer(body)
+        self.time_s += time.perf_counter() - started
+        return _response(response)
+
+    def msearch(self, searches=None, **kwargs):
+        started = time.perf_counter()
+        self.counters["msearches"] += 1
+        responses = [self._answer(body) for body in searches[1::2]]
+        self.time_s += time.perf_counter() - started
+        return _response({"took": 1, "responses": responses})
+
+    def bulk(self, operations=None, **kwargs):
+        started = time.perf_counter()
+        items = []
+        # Action lines and source lines alternate, both already serialized
+        for action in operations[::2]:
+            if isinstance(action, (bytes, str)):
+                action = json.loads(action)
+            op_type, meta = next(iter(action.items()))
+            items.append({op_type: {"_index": meta.get("_index"), "_id": meta.get("_id"), "status": 201}})
+        self.counters["bulk_requests"] += 1
+        self.counters["bulk_documents"] += len(items)
+        self.time_s += time.perf_counter() - started
+        return _response({"took": 1, "errors": False, "items": items})
+
+    def delete_by_query(self, index=None, **kwargs):
+        self.counters["deleted_by_query"] += 1
+        return _response({"deleted": 0})
+
+
+class SyntheticServices:
+    # Service registry source, see registry.py
+    def __init__(self, logs: SyntheticLogs):
+        self.logs = logs
+
+    def rows(self):
+        return self.logs.rows()
+
+    def version(self):
+        return len(self.logs.service_ids)
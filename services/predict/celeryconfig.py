@@ -8,10 +8,22 @@ assert REDIS_URL
 broker_url = REDIS_URL
 result_backend = REDIS_URL
 
+# REDIS_URL="memory://" runs every task inline in the calling process, which is
+# enough to exercise the fan-out pipeline locally without a broker
+if REDIS_URL.startswith("memory://"):
+    result_backend = "cache+memory://"
+    task_always_eager = True
+
+# Per-service tasks are CPU bound, so hand them out one at a time
+worker_prefetch_multiplier = 1
+
 beat_schedule = {
     "run-predict-pipeline": {
         "task": "tasks.run_pipeline",
         "schedule": crontab(minute="*/1"),
+        # A start still queued when the next one is due is dropped by the
+        # worker instead of piling up behind a slow run
+        "options": {"expires": 60},
     },
 }
 
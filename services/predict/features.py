@@ -0,0 +1,108 @@
+import numpy as np
+import pandas as pd
+
+HOUR_MS = 3600 * 1000
+DAY_MS = 24 * HOUR_MS
+
+# Forecast targets, as output column -> stage-1 column. They are fitted
+# together, with one multi-output model per service.
+TARGETS = {
+    "latency": "latency_stats.avg",
+    "latency_p50": "latency_percentiles.p50",
+    "latency_p90": "latency_percentiles.p90",
+    "latency_p99": "latency_percentiles.p99",
+}
+
+
+# ISO weekday (Monday = 1 ... Sunday = 7) straight from epoch milliseconds.
+# 1970-01-01 was a Thursday, hence the offset of 3.
+def iso_weekday(ts: np.ndarray) -> np.ndarray:
+    return (np.floor_divide(ts, DAY_MS).astype(np.int64) + 3) % 7 + 1
+
+
+def to_iso(ts: np.ndarray) -> np.ndarray:
+    return np.datetime_as_string(ts.astype("datetime64[ms]"), unit="s")
+
+
+# Training samples and one column per target from a stage-1 frame, in the
+# order they were stored. Day of week and weekend are derived from ts the same
+# way forecast_frame() does, rather than trusted from the stored columns.
+def history_columns(frame: pd.DataFrame, targets: dict = TARGETS):
+    ts = frame["ts"].to_numpy(dtype=np.float64)
+    dow = iso_weekday(ts)
+    X = np.column_stack([ts, dow, dow >= 6]).astype(np.float64)
+    Y = frame[list(targets.values())].to_numpy(dtype=np.float64)
+    return X, Y
+
+
+def has_targets(frame: pd.DataFrame, targets: dict = TARGETS) -> bool:
+    return all(column in frame.columns for column in targets.values())
+
+
+# Hourly grid from the oldest stored bucket up to `end_ms`, with the features
+# used for prediction and the actual values wherever a stored bucket matches
+def forecast_frame(
+    start_ms: float, end_ms: float, history_ts, history_Y, targets: dict = TARGETS
+):
+    ts = np.arange(start_ms, end_ms + 1, HOUR_MS, dtype=np.float64)
+    dow = iso_weekday(ts)
+    weekend = dow >= 6
+
+    positions = pd.Index(history_ts).get_indexer(ts)
+    actual = np.full((len(ts), len(targets)), np.nan)
+    matched = positions >= 0
+    actual[matched] = history_Y[positions[matched]]
+
+    frame = pd.DataFrame({"ts": ts, "dow": dow, "weekend": weekend})
+    for idx, target in enumerate(targets):
+        frame[target] = actual[:, idx]
+    return frame
+
+
+# Start of every resolution window, newest first, as (hours per row, first ts).
+# `resolutions` is a list of {"within": <timedelta kwargs>, "hours": n}, from
+# the most recent window outwards. Window edges are aligned to the bins of the
+# coarser window beyond them, so no bin straddles two windows.
+def resolution_edges(now_ms: float, resolutions: list):
+    edges = []
+    for idx, resolution in enumerate(resolutions):
+        outer = resolutions[min(idx + 1, len(resolutions) - 1)]
+        within_ms = pd.Timedelta(**resolution["within"]).total_seconds() * 1000
+        bin_ms = outer["hours"] * HOUR_MS
+        edges.append((resolution["hours"], (now_ms - within_ms) // bin_ms * bin_ms))
+    return edges
+
+
+# Averages rows into bins of each window's resolution and drops rows older than
+# the last window. Everything from the first edge on, forecasts included, keeps
+# the resolution of the first window. The number of rows only depends on the
+# windows and the forecast range, not on how much history is stored.
+def downsample(frame: pd.DataFrame, now_ms: float, resolutions: list) -> pd.DataFrame:
+    edges = resolution_edges(now_ms, resolutions)
+    ts = frame["ts"].to_numpy()
+    values = frame.drop(columns=["ts_iso", "ts", "dow", "weekend"], errors="ignore")
+    parts = []
+    newer_than = np.inf
+    for hours, older_than in edges:
+        selected = (ts >= older_than) & (ts < newer_than)
+        newer_than = older_than
+        if not selected.any():
+            continue
+        bin_ms = hours * HOUR_MS
+        bins = ts[selected] // bin_ms * bin_ms
+        part = values[selected].groupby(bins, sort=True).mean()
+        part.insert(0, "ts", part.index.to_numpy(dtype=np.float64))
+        part["resolution_h"] = hours
+        parts.append(part)
+    if not parts:
+        return frame.iloc[:0].assign(resolution_h=[])
+    result = pd.concat(parts).sort_values("ts").reset_index(drop=True)
+    result.insert(0, "ts_iso", to_iso(result["ts"].to_numpy()))
+    dow = iso_weekday(result["ts"].to_numpy())
+    result.insert(2, "dow", dow)
+    result.insert(3, "weekend", dow >= 6)
+    return result
+
+
+def samples(frame: pd.DataFrame) -> np.ndarray:
+    return frame[["ts", "dow", "weekend"]].to_numpy(dtype=np.float64)
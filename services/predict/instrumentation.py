@@ -0,0 +1,151 @@
+import os
+import glob
+import json
+import time
+import socket
+import resource
+import threading
+from contextlib import contextmanager
+
+
+def peak_rss_bytes() -> int:
+    # ru_maxrss is reported in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class Recorder:
+    # Every measurement is appended to <directory>/metrics.jsonl as one JSON
+    # object, and aggregated in the Prometheus text format (e.g. for the
+    # node_exporter textfile collector) on flush(). Each worker process only
+    # knows its own measurements, so it writes its own
+    # metrics-<host>-<pid>.prom with a `pid` label on every series; files of
+    # processes that exited on this host are removed. metrics.jsonl is moved
+    # to metrics.jsonl.1 once it passes `max_jsonl_bytes`.
+    def __init__(
+        self, directory: str, prefix: str = "predict", max_jsonl_bytes: int = 64 * 1024 * 1024
+    ):
+        self.directory = directory
+        self.prefix = prefix
+        self.max_jsonl_bytes = max_jsonl_bytes
+        self.host = socket.gethostname()
+        self._lock = threading.Lock()
+        self._summaries = {}
+        self._counters = {}
+        self._gauges = {}
+        # A forked worker starts from zero instead of repeating the parent's
+        os.register_at_fork(after_in_child=self._reset)
+        os.makedirs(directory, exist_ok=True)
+
+    def _reset(self):
+        self._lock = threading.Lock()
+        self._summaries = {}
+        self._counters = {}
+        self._gauges = {}
+
+    def emit(self, event: str, **fields):
+        line = json.dumps({"ts": time.time(), "event": event, **fields}, default=str)
+        path = f"{self.directory}/metrics.jsonl"
+        with self._lock:
+            with open(path, "a") as file:
+                file.write(line + "\n")
+                full = file.tell() >= self.max_jsonl_bytes
+            if full:
+                try:
+                    os.replace(path, f"{path}.1")
+                except FileNotFoundError:
+                    # Another process rotated it first
+                    pass
+
+    def _key(self, name: str, labels: dict):
+        return f"{self.prefix}_{name}", tuple(sorted(labels.items()))
+
+    def observe(self, name: str, value: float, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            count, total = self._summaries.get(key, (0, 0.0))
+            self._summaries[key] = (count + 1, total + value)
+
+    def count(self, name: str, value: float = 1, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def gauge(self, name: str, value: float, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self._gauges[key] = value
+
+    # Measures wall and CPU time of the block. Fields set on the yielded dict
+    # (row counts, ...) end up in the same JSON line; wall_s and cpu_s are
+    # added to it once the block is done.
+    @contextmanager
+    def timer(self, name: str, **labels):
+        fields = {}
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield fields
+        finally:
+            wall = time.perf_counter() - wall
+            cpu = time.process_time() - cpu
+            self.observe(f"{name}_wall_seconds", wall, **labels)
+            self.observe(f"{name}_cpu_seconds", cpu, **labels)
+            if "rows" in fields:
+                self.count(f"{name}_rows_total", fields["rows"], **labels)
+            self.emit(name, wall_s=wall, cpu_s=cpu, **labels, **fields)
+            fields.update(wall_s=wall, cpu_s=cpu)
+
+    def prune(self):
+        for path in glob.glob(f"{self.directory}/metrics-{self.host}-*.prom"):
+            pid = path[: -len(".prom")].rsplit("-", 1)[1]
+            if pid.isdigit() and not pid_alive(int(pid)):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+    def flush(self):
+        self.gauge("peak_rss_bytes", peak_rss_bytes())
+        pid = os.getpid()
+        path = f"{self.directory}/metrics-{self.host}-{pid}.prom"
+        lines = []
+        with self._lock:
+            for kind, series in [("counter", self._counters), ("gauge", self._gauges)]:
+                for name in sorted({name for name, _ in series}):
+                    lines.append(f"# TYPE {name} {kind}")
+                    for (_name, labels), value in series.items():
+                        if _name == name:
+                            labels = format_labels(labels, pid)
+                            lines.append(f"{name}{labels} {value}")
+            for name in sorted({name for name, _ in self._summaries}):
+                lines.append(f"# TYPE {name} summary")
+                for (_name, labels), (count, total) in self._summaries.items():
+                    if _name == name:
+                        labels = format_labels(labels, pid)
+                        lines.append(f"{name}_count{labels} {count}")
+                        lines.append(f"{name}_sum{labels} {total}")
+        with open(f"{path}.tmp", "w") as file:
+            file.write("\n".join(lines) + "\n")
+        os.replace(f"{path}.tmp", path)
+        self.prune()
+
+
+def format_labels(labels, pid: int = None) -> str:
+    if pid is not None:
+        labels = (*labels, ("pid", pid))
+    if not labels:
+        return ""
+    pairs = []
+    for key, value in labels:
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"')
+        pairs.append(f'{key}="{value}"')
+    return "{" + ",".join(pairs) + "}"
@@ -0,0 +1,158 @@
+import os
+import glob
+import json
+import time
+import hashlib
+import joblib
+import numpy as np
+
+
+class ModelCache:
+    # Fitted models live at <root>/<service_id>/models/<name>-<fingerprint>.joblib.
+    # The fingerprint covers the model name, its hyperparameters and the training
+    # data, so a file only exists for a fit that would produce the same model.
+    # With key="buckets" only the samples (timestamp, dow, weekend) are hashed:
+    # changes to the hour that is still filling up reuse the cached model and a
+    # refit only happens once a new hour bucket shows up.
+    #
+    # Files are compressed: a 200-tree forest on a month of buckets shrinks to
+    # about half. evict() scans every file, so it runs once per pipeline run
+    # rather than after every dump; until then the cache may overshoot.
+    def __init__(self, root: str, max_bytes: int, max_age: float, key: str = "data"):
+        assert key in ["data", "buckets"]
+        self.root = root
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.key = key
+        self.hits = 0
+        self.misses = 0
+        self.updates = 0
+        self.evictions = 0
+
+    def fingerprint(self, name: str, params: dict, X, y) -> str:
+        digest = hashlib.sha256()
+        digest.update(name.encode())
+        digest.update(json.dumps(params, sort_keys=True).encode())
+        samples = np.ascontiguousarray(X, dtype=np.float64)
+        digest.update(str(samples.shape).encode())
+        digest.update(samples.tobytes())
+        # Number of targets, so a model is never reused for a different output
+        digest.update(str(np.shape(y)[1:]).encode())
+        if self.key == "data":
+            digest.update(np.ascontiguousarray(y, dtype=np.float64).tobytes())
+        return digest.hexdigest()[:32]
+
+    def path(self, service_id: str, name: str, fingerprint: str) -> str:
+        return f"{self.root}/{service_id}/models/{name}-{fingerprint}.joblib"
+
+    def get_or_fit(self, service_id: str, name: str, factory, params: dict, X, y):
+        fingerprint = self.fingerprint(name, params, X, y)
+        path = self.path(service_id, name, fingerprint)
+        if os.path.exists(path):
+            try:
+                model = joblib.load(path)
+                self.hits += 1
+                # mtime doubles as last-use time for eviction
+                os.utime(path)
+                return model
+            except Exception as err:
+                print("discard unreadable model", path, err)
+
+        self.misses += 1
+        model = factory(**params).fit(X, y)
+
+        for stale in glob.glob(self.path(service_id, name, "*")):
+            if stale != path:
+                self._remove(stale, evicted=False)
+        self._dump(model, path)
+        return model
+
+    # For models with partial_fit(): the stored model of `name` is updated with
+    # the samples newer than the last one it has seen, and only fitted from
+    # scratch when there is none yet. The newest bucket is left out, as the
+    # current hour is still filling up. Files are named
+    # <name>-<fingerprint of name, params and shapes>-<last sample ts>.joblib.
+    def get_or_update(self, service_id: str, name: str, factory, params: dict, X, y):
+        y = np.asarray(y)
+        order = np.argsort(X[:, 0], kind="stable")
+        X, y = X[order], y[order]
+        complete = X[:, 0] < X[-1, 0]
+        X, y = X[complete], y[complete]
+        key = self.fingerprint(name, params, X[:0], y[:0])
+
+        stored = []
+        for path in glob.glob(self.path(service_id, name, f"{key}-*")):
+            try:
+                stored.append((float(path.rsplit("-", 1)[1][: -len(".joblib")]), path))
+            except ValueError:
+                continue
+        model = None
+        last_ts = None
+        if stored:
+            last_ts, path = max(stored)
+            try:
+                model = joblib.load(path)
+            except Exception as err:
+                print("discard unreadable model", path, err)
+        if model is None and not len(X):
+            return None
+
+        if model is None:
+            self.misses += 1
+            model = factory(**params).fit(X, y)
+        else:
+            new = X[:, 0] > last_ts
+            if not new.any():
+                self.hits += 1
+                os.utime(path)
+                return model
+            self.updates += 1
+            model.partial_fit(X[new], y[new])
+
+        path = self.path(service_id, name, f"{key}-{int(X[-1, 0])}")
+        for stale in glob.glob(self.path(service_id, name, "*")):
+            if stale != path:
+                self._remove(stale, evicted=False)
+        self._dump(model, path)
+        return model
+
+    def _dump(self, model, path: str):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        joblib.dump(model, f"{path}.tmp", compress=3)
+        os.replace(f"{path}.tmp", path)
+
+    def evict(self):
+        now = time.time()
+        entries = []
+        for path in glob.glob(self.path("*", "*", "*")):
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            if now - stat.st_mtime > self.max_age:
+                self._remove(path)
+            else:
+                entries.append((stat.st_mtime, stat.st_size, path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            self._remove(path)
+            total -= size
+
+    # A service's own outdated model is replaced, not evicted
+    def _remove(self, path: str, evicted: bool = True):
+        try:
+            os.remove(path)
+            self.evictions += evicted
+        except OSError:
+            pass
+
+    def stats(self) -> dict:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "updates": self.updates,
+            "evictions": self.evictions,
+        }
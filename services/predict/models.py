@@ -0,0 +1,74 @@
+import typing as T
+import numpy as np
+from sklearn.linear_model import LinearRegression, SGDRegressor
+from sklearn.ensemble import RandomForestRegressor, HistGradientBoostingRegressor
+from sklearn.multioutput import MultiOutputRegressor
+from sklearn.preprocessing import StandardScaler
+
+
+class OnlineRegressor:
+    # One SGD regressor per target on standardized samples, so that a refresh
+    # only needs the buckets added since the last one. The scaling is fixed by
+    # the first fit; later timestamps just land further out on the same scale.
+    def __init__(self, alpha: float = 1e-4, epochs: int = 20, random_state: int = 0):
+        self.alpha = alpha
+        self.epochs = epochs
+        self.random_state = random_state
+        self.scaler = None
+        self.models = None
+
+    def partial_fit(self, X, Y, epochs: int = 1):
+        Y = np.asarray(Y).reshape(len(X), -1)
+        if self.scaler is None:
+            self.scaler = StandardScaler().fit(X)
+            self.models = [
+                SGDRegressor(alpha=self.alpha, random_state=self.random_state)
+                for _ in range(Y.shape[1])
+            ]
+        samples = self.scaler.transform(X)
+        for _ in range(epochs):
+            for idx, model in enumerate(self.models):
+                model.partial_fit(samples, Y[:, idx])
+        return self
+
+    def fit(self, X, Y):
+        self.scaler = None
+        return self.partial_fit(X, Y, self.epochs)
+
+    def predict(self, X):
+        samples = self.scaler.transform(X)
+        return np.column_stack([model.predict(samples) for model in self.models])
+
+
+# HistGradientBoostingRegressor has a single output
+def hist_gradient_boosting(**params):
+    return MultiOutputRegressor(HistGradientBoostingRegressor(**params))
+
+
+class Engine(T.NamedTuple):
+    factory: T.Callable
+    params: T.Dict
+    # Refreshed with partial_fit() on new buckets instead of being refitted
+    online: bool = False
+
+
+ENGINES = {
+    # The original pair
+    "random_forest": Engine(RandomForestRegressor, {"n_estimators": 200}),
+    "linear": Engine(LinearRegression, {}),
+    # Shallower, fewer trees, on every core
+    "random_forest_bounded": Engine(
+        RandomForestRegressor,
+        {
+            "n_estimators": 100,
+            "max_depth": 12,
+            "min_samples_leaf": 4,
+            "n_jobs": -1,
+            "random_state": 0,
+        },
+    ),
+    "hist_gradient_boosting": Engine(
+        hist_gradient_boosting, {"max_iter": 200, "random_state": 0}
+    ),
+    "sgd": Engine(OnlineRegressor, {}, online=True),
+}
@@ -0,0 +1,289 @@
+import os
+import time
+import glob
+import math
+import threading
+import typing as T
+from collections import deque
+import numpy as np
+from flask import Flask, request, jsonify, g
+import artifacts
+from instrumentation import Recorder
+
+DATA_DIR = "output"
+METRICS_DIR = os.environ.get("METRICS_DIR", "metrics")
+ARTIFACT_FORMAT = os.environ.get("ARTIFACT_FORMAT", "npz")
+QUERY_REFRESH_SECONDS = float(os.environ.get("QUERY_REFRESH_SECONDS", "5"))
+QUERY_MAX_POINTS = int(os.environ.get("QUERY_MAX_POINTS", "10000"))
+
+HOUR_MS = 3600 * 1000
+
+ARTIFACTS = artifacts.ArtifactStore(DATA_DIR, format=ARTIFACT_FORMAT)
+
+RECORDER = Recorder(f"{METRICS_DIR}/query", prefix="predict_query")
+
+
+class Forecast(T.NamedTuple):
+    # One service's stage-2 output: rows sorted by ts, every row covering
+    # [ts, end) (its resolution, up to where the next row starts), and one
+    # float64 array per numeric column
+    ts: np.ndarray
+    end: np.ndarray
+    columns: T.Dict[str, np.ndarray]
+    # Model used per target when none is asked for: the lowest MAE
+    best_models: T.Dict[str, str]
+    meta: T.Dict
+    mtime: float
+
+
+class Snapshot(T.NamedTuple):
+    forecasts: T.Dict[str, Forecast]
+    generation: int
+    loaded_at: float
+
+
+def load_forecast(service_id: str, mtime: float) -> T.Optional[Forecast]:
+    meta, frame = ARTIFACTS.load(service_id, "stage-2")
+    if frame is None or "ts" not in frame.columns or not len(frame):
+        return None
+    frame = frame.sort_values("ts")
+    ts = frame["ts"].to_numpy(dtype=np.float64)
+    resolution = (
+        frame["resolution_h"].to_numpy(dtype=np.float64)
+        if "resolution_h" in frame.columns
+        else np.ones(len(ts))
+    )
+    columns = {
+        column: frame[column].to_numpy(dtype=np.float64)
+        for column in frame.columns
+        if column not in ["ts", "ts_iso", "dow", "weekend", "resolution_h"]
+    }
+    best_models = {}
+    for target in meta.get("targets", []):
+        scores = meta.get("target_metrics", {}).get(target, {})
+        ranked = sorted(
+            (scores[f"mae_{name}"], name)
+            for name in meta.get("models", [])
+            if scores.get(f"mae_{name}") is not None and f"{target}_{name}" in columns
+        )
+        if ranked:
+            best_models[target] = ranked[0][1]
+    summary = {
+        key: meta[key] for key in ["models", "targets", "predict_range"] if key in meta
+    }
+    end = np.minimum(ts + resolution * HOUR_MS, np.append(ts[1:], np.inf))
+    return Forecast(ts, end, columns, best_models, summary, mtime)
+
+
+def artifact_mtimes() -> dict:
+    mtimes = {}
+    for path in glob.glob(ARTIFACTS.path("*", "stage-2")):
+        service_id = os.path.relpath(path, DATA_DIR).split(os.sep)[0]
+        try:
+            mtimes[service_id] = os.stat(path).st_mtime
+        except FileNotFoundError:
+            pass
+    return mtimes
+
+
+# Readers take `snapshot` once per request and never see it change: a refresh
+# builds a whole new Snapshot (reusing the unchanged services' arrays) and
+# swaps the reference.
+snapshot = Snapshot({}, 0, time.time())
+refresh_lock = threading.Lock()
+
+
+def refresh():
+    global snapshot
+    with refresh_lock:
+        current = snapshot
+        mtimes = artifact_mtimes()
+        changed = [
+            service_id
+            for service_id, mtime in mtimes.items()
+            if service_id not in current.forecasts
+            or current.forecasts[service_id].mtime != mtime
+        ]
+        removed = [service_id for service_id in current.forecasts if service_id not in mtimes]
+        if not changed and not removed:
+            return False
+        forecasts = {
+            service_id: forecast
+            for service_id, forecast in current.forecasts.items()
+            if service_id in mtimes
+        }
+        for service_id in changed:
+            try:
+                forecast = load_forecast(service_id, mtimes[service_id])
+            except Exception as err:
+                # The old arrays stay until the next try
+                print("Failed to load", service_id, err)
+                continue
+            if forecast is None:
+                forecasts.pop(service_id, None)
+            else:
+                forecasts[service_id] = forecast
+        snapshot = Snapshot(forecasts, current.generation + 1, time.time())
+        RECORDER.count("reloaded_services_total", len(changed))
+        return True
+
+
+def refresh_loop():
+    while True:
+        time.sleep(QUERY_REFRESH_SECONDS)
+        try:
+            refresh()
+        except Exception as err:
+            print("Refresh failed:", err)
+        current = snapshot
+        RECORDER.gauge("services", len(current.forecasts))
+        RECORDER.gauge("generation", current.generation)
+        RECORDER.gauge("snapshot_age_seconds", time.time() - current.loaded_at)
+        if current.forecasts:
+            newest = max(forecast.mtime for forecast in current.forecasts.values())
+            RECORDER.gauge("forecast_age_seconds", time.time() - newest)
+        RECORDER.flush()
+
+
+def value(array: np.ndarray, idx: int):
+    number = float(array[idx])
+    return None if math.isnan(number) else number
+
+
+def column(forecast: Forecast, target: str, model: T.Optional[str]):
+    if model is None:
+        model = forecast.best_models.get(target)
+    name = f"{target}_{model}"
+    if name not in forecast.columns:
+        return None, None
+    return model, forecast.columns[name]
+
+
+# Query parameter as a float, ValueError when it is not a number
+def number_arg(name: str, default: T.Optional[float]) -> T.Optional[float]:
+    raw = request.args.get(name)
+    if raw is None:
+        return default
+    number = float(raw)
+    if math.isnan(number):
+        raise ValueError(raw)
+    return number
+
+
+app = Flask(__name__)
+
+# Recent request latencies per endpoint, for /metrics percentiles
+latencies = {}
+
+
+@app.before_request
+def start_timer():
+    g.started = time.perf_counter()
+
+
+@app.after_request
+def record_latency(response):
+    elapsed = time.perf_counter() - g.started
+    endpoint = request.endpoint or "unknown"
+    latencies.setdefault(endpoint, deque(maxlen=10000)).append(elapsed)
+    RECORDER.observe("request_seconds", elapsed, endpoint=endpoint)
+    RECORDER.count("requests_total", endpoint=endpoint, status=response.status_code)
+    return response
+
+
+@app.get("/forecast/<service_id>")
+def forecast(service_id):
+    current = snapshot
+    forecast = current.forecasts.get(service_id)
+    if forecast is None:
+        return jsonify({"error": f"no forecast for {service_id}"}), 404
+    target = request.args.get("target", "latency")
+    model, values = column(forecast, target, request.args.get("model"))
+    if values is None:
+        return jsonify({"error": f"no {target} forecast from model {model}"}), 404
+    response = {
+        "service_id": service_id,
+        "target": target,
+        "model": model,
+        "generation": current.generation,
+    }
+
+    try:
+        t = number_arg("t", None)
+        start = number_arg("start", -math.inf)
+        end = number_arg("end", math.inf)
+    except ValueError:
+        return jsonify({"error": "t, start and end must be numbers (ms)"}), 400
+
+    if t is not None:
+        # Last row starting at or before t, if it still covers t
+        idx = int(np.searchsorted(forecast.ts, t, side="right")) - 1
+        if idx < 0 or t >= forecast.end[idx]:
+            return jsonify({**response, "error": "t is outside the forecast"}), 404
+        actual = forecast.columns.get(target)
+        response.update(
+            ts=float(forecast.ts[idx]),
+            resolution_h=(float(forecast.end[idx]) - float(forecast.ts[idx])) / HOUR_MS,
+            value=value(values, idx),
+            actual=value(actual, idx) if actual is not None else None,
+        )
+        return jsonify(response)
+
+    # Rows overlapping [start, end]
+    first = int(np.searchsorted(forecast.end, start, side="right"))
+    last = int(np.searchsorted(forecast.ts, end, side="right"))
+    truncated = last - first > QUERY_MAX_POINTS
+    last = min(last, first + QUERY_MAX_POINTS)
+    selected = values[first:last]
+    response.update(
+        ts=forecast.ts[first:last].tolist(),
+        values=np.where(np.isnan(selected), None, selected).tolist(),
+        truncated=truncated,
+    )
+    return jsonify(response)
+
+
+@app.get("/services")
+def services():
+    current = snapshot
+    return jsonify(
+        {
+            service_id: {
+                **forecast.meta,
+                "best_models": forecast.best_models,
+                "rows": len(forecast.ts),
+                "loaded_mtime": forecast.mtime,
+            }
+            for service_id, forecast in current.forecasts.items()
+        }
+    )
+
+
+@app.get("/metrics")
+def metrics():
+    current = snapshot
+    now = time.time()
+    newest = max((forecast.mtime for forecast in current.forecasts.values()), default=None)
+    requests = {}
+    for endpoint, recent in list(latencies.items()):
+        recent = np.array(recent) * 1e6
+        requests[endpoint] = {
+            "count": len(recent),
+            **{
+                f"p{percent}_us": float(np.percentile(recent, percent))
+                for percent in [50, 90, 99]
+            },
+        }
+    return jsonify(
+        {
+            "services": len(current.forecasts),
+            "generation": current.generation,
+            "snapshot_age_s": now - current.loaded_at,
+            "forecast_age_s": now - newest if newest is not None else None,
+            "requests": requests,
+        }
+    )
+
+
+refresh()
+threading.Thread(target=refresh_loop, name="forecast-refresh", daemon=True).start()
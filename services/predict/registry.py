@@ -0,0 +1,199 @@
+import os
+import json
+import time
+import select
+import threading
+from contextlib import contextmanager
+import psycopg2
+import psycopg2.pool
+
+SERVICES_QUERY = "SELECT id, name, host FROM services"
+VERSION_QUERY = "SELECT count(*), max(updated_at) FROM services"
+
+
+class PostgresSource:
+    # Kong's `services` table through a small connection pool, created lazily
+    # so that every forked worker process gets its own connections. With
+    # versioned=True, version() is a single-row query that changes whenever a
+    # service is added, updated or removed.
+    def __init__(self, dsn: str, pool_size: int = 2, versioned: bool = True):
+        self.dsn = dsn
+        self.pool_size = pool_size
+        self.versioned = versioned
+        self._pool = None
+        self._pid = None
+
+    def __repr__(self):
+        return "PostgresSource"
+
+    def pool(self):
+        if self._pool is None or self._pid != os.getpid():
+            self._pool = psycopg2.pool.ThreadedConnectionPool(1, self.pool_size, self.dsn)
+            self._pid = os.getpid()
+        return self._pool
+
+    @contextmanager
+    def cursor(self):
+        pool = self.pool()
+        conn = pool.getconn()
+        broken = False
+        try:
+            conn.autocommit = True
+            with conn.cursor() as cursor:
+                yield cursor
+        except psycopg2.Error:
+            broken = True
+            raise
+        finally:
+            # A connection that failed is closed rather than reused
+            pool.putconn(conn, close=broken)
+
+    def rows(self):
+        with self.cursor() as cursor:
+            cursor.execute(SERVICES_QUERY)
+            return [tuple(row) for row in cursor.fetchall()]
+
+    def version(self):
+        if not self.versioned:
+            return None
+        with self.cursor() as cursor:
+            cursor.execute(VERSION_QUERY)
+            return tuple(cursor.fetchone())
+
+    # Calls `callback` on every NOTIFY on `channel`, from a background thread
+    # with its own connection. Kong does not notify by itself; a trigger like
+    # this one has to be added to its database:
+    #
+    #   CREATE FUNCTION notify_services_changed() RETURNS trigger AS $$
+    #   BEGIN PERFORM pg_notify('kong_services', TG_OP); RETURN NULL; END;
+    #   $$ LANGUAGE plpgsql;
+    #   CREATE TRIGGER services_changed AFTER INSERT OR UPDATE OR DELETE
+    #   ON services FOR EACH STATEMENT EXECUTE FUNCTION notify_services_changed();
+    def listen(self, channel: str, callback, retry_s: float = 10):
+        def listen_loop():
+            while True:
+                try:
+                    conn = psycopg2.connect(self.dsn)
+                    conn.autocommit = True
+                    with conn.cursor() as cursor:
+                        cursor.execute(f"LISTEN {channel}")
+                    # Anything may have changed while we were not listening
+                    callback()
+                    while True:
+                        if select.select([conn], [], [], 60) == ([], [], []):
+                            continue
+                        conn.poll()
+                        if conn.notifies:
+                            conn.notifies.clear()
+                            callback()
+                except Exception as err:
+                    print("service registry listener:", err)
+                    time.sleep(retry_s)
+
+        thread = threading.Thread(target=listen_loop, name="registry-listener", daemon=True)
+        thread.start()
+        return thread
+
+
+class SnapshotSource:
+    # A Kong configuration snapshot: Konga's ({"data": {"services": [...]}})
+    # or a decK dump in JSON ({"services": [...]}). decK leaves ids out unless
+    # asked to, in which case the name stands in for the id.
+    def __init__(self, path: str):
+        self.path = path
+
+    def __repr__(self):
+        return f"SnapshotSource({self.path})"
+
+    def rows(self):
+        with open(self.path, "r") as file:
+            snapshot = json.load(file)
+        services = snapshot.get("data", snapshot).get("services", [])
+        return [
+            (service.get("id") or service["name"], service["name"], service.get("host"))
+            for service in services
+        ]
+
+    def version(self):
+        return os.stat(self.path).st_mtime_ns
+
+
+class ServiceRegistry:
+    # Service rows (id, name, host) from the first source that answers, served
+    # from memory. Once `ttl` seconds have passed, the source's version is
+    # compared and the rows are only reloaded if it changed (sources without a
+    # version are simply reloaded); invalidate(), e.g. on a NOTIFY, forces a
+    # reload on the next call. When no source answers, the last rows are kept.
+    # `watch(callback)` starts whatever calls invalidate() (a listener thread);
+    # it runs on first use in every process, since threads do not survive a
+    # fork into the worker processes.
+    def __init__(self, sources: list, ttl: float, watch=None):
+        assert sources
+        self.sources = sources
+        self.ttl = ttl
+        self.watch = watch
+        self._watching = None
+        self._lock = threading.Lock()
+        self._rows = None
+        self._source = None
+        self._version = None
+        self._checked = None
+        self._stale = False
+        self.counters = {"hits": 0, "checks": 0, "loads": 0, "failures": 0}
+
+    def invalidate(self):
+        self._stale = True
+
+    def _fresh(self, now):
+        return (
+            self._rows is not None
+            and not self._stale
+            and now - self._checked < self.ttl
+        )
+
+    def _start_watch(self):
+        with self._lock:
+            if self._watching != os.getpid():
+                self._watching = os.getpid()
+                self.watch(self.invalidate)
+
+    def services(self):
+        if self.watch is not None and self._watching != os.getpid():
+            self._start_watch()
+        now = time.monotonic()
+        if self._fresh(now):
+            self.counters["hits"] += 1
+            return self._rows
+        with self._lock:
+            if self._fresh(now):
+                self.counters["hits"] += 1
+                return self._rows
+            # Cleared before loading, so a change notified meanwhile is not lost
+            stale, self._stale = self._stale, False
+            for source in self.sources:
+                try:
+                    self.counters["checks"] += 1
+                    version = source.version()
+                    if (
+                        stale
+                        or version is None
+                        or source is not self._source
+                        or version != self._version
+                    ):
+                        self._rows = source.rows()
+                        self.counters["loads"] += 1
+                    self._source = source
+                    self._version = version
+                    self._checked = now
+                    return self._rows
+                except Exception as err:
+                    self.counters["failures"] += 1
+                    print("service registry:", source, "unavailable:", err)
+            if self._rows is None:
+                raise RuntimeError("no service registry source available")
+            # Keep the last rows and try again after another ttl
+            self._checked = now
+            return self._rows
+
+    def stats(self) -> dict:
+        return {**self.counters, "services": len(self._rows or [])}
@@ -0,0 +1,147 @@
+import uuid
+import threading
+import redis
+
+
+class RunLock:
+    # A lease in Redis: SET NX PX with a random token, extended by a background
+    # thread while the holder is alive and deleted only by the holder. Renewal
+    # and release use WATCH/MULTI rather than Lua so they also run on fakeredis.
+    def __init__(self, client, key: str, lease_ms: int):
+        self.client = client
+        self.key = key
+        self.lease_ms = lease_ms
+        self.token = None
+        self._stop = threading.Event()
+        self._renewer = None
+
+    def acquire(self, token: str = None) -> bool:
+        token = token or uuid.uuid4().hex
+        if not self.client.set(self.key, token, nx=True, px=self.lease_ms):
+            return False
+        self.token = token
+        return True
+
+    def _compare_and(self, action) -> bool:
+        with self.client.pipeline() as pipe:
+            try:
+                pipe.watch(self.key)
+                current = pipe.get(self.key)
+                if current is None or current.decode() != self.token:
+                    pipe.unwatch()
+                    return False
+                pipe.multi()
+                action(pipe)
+                pipe.execute()
+                return True
+            except redis.WatchError:
+                return False
+
+    def renew(self) -> bool:
+        return self._compare_and(lambda pipe: pipe.pexpire(self.key, self.lease_ms))
+
+    def release(self) -> bool:
+        self.stop_renewing()
+        released = self._compare_and(lambda pipe: pipe.delete(self.key))
+        self.token = None
+        return released
+
+    def start_renewing(self):
+        def renew_loop():
+            while not self._stop.wait(self.lease_ms / 3000):
+                if not self.renew():
+                    print("lost run lock", self.key)
+                    return
+
+        self._stop.clear()
+        self._renewer = threading.Thread(target=renew_loop, daemon=True)
+        self._renewer.start()
+
+    def stop_renewing(self):
+        self._stop.set()
+        if self._renewer is not None:
+            self._renewer.join()
+            self._renewer = None
+
+
+class RunCoordinator:
+    # Only one pipeline run at a time across all workers. A start that finds the
+    # lock taken only bumps <prefix>:pending and returns; the holder then does a
+    # single extra run for all of them once it is done. Totals per outcome are
+    # kept in the <prefix>:runs hash.
+    def __init__(self, client, prefix: str, lease_ms: int):
+        self.client = client
+        self.prefix = prefix
+        self.lease_ms = lease_ms
+
+    # With `token`, a handle on a lock acquired elsewhere (e.g. by the task
+    # that started a fanned-out run), which can renew and release it
+    def lock(self, token: str = None) -> RunLock:
+        lock = RunLock(self.client, f"{self.prefix}:lock", self.lease_ms)
+        lock.token = token
+        return lock
+
+    def report(self, outcome: str, count: int = 1):
+        self.client.hincrby(f"{self.prefix}:runs", outcome, count)
+
+    def request(self) -> int:
+        self.report("coalesced")
+        return self.client.incr(f"{self.prefix}:pending")
+
+    def take_pending(self) -> int:
+        return int(self.client.getdel(f"{self.prefix}:pending") or 0)
+
+    def stats(self) -> dict:
+        return {
+            key.decode(): int(value)
+            for key, value in self.client.hgetall(f"{self.prefix}:runs").items()
+        }
+
+    def run(self, func):
+        runs = 0
+        coalesced = 0
+        while True:
+            lock = self.lock()
+            if not lock.acquire():
+                if not runs:
+                    return {"status": "coalesced", "pending": self.request()}
+                # Someone else took over right after our release and will pick
+                # up whatever is still pending
+                break
+            lock.start_renewing()
+            try:
+                while True:
+                    # Everything requested so far is covered by the run below
+                    coalesced += self.take_pending()
+                    self.report("started")
+                    func()
+                    runs += 1
+                    if not int(self.client.get(f"{self.prefix}:pending") or 0):
+                        break
+            finally:
+                lock.release()
+            # A request that came in between the last check and the release
+            # found the lock still held, so check once more
+            if not int(self.client.get(f"{self.prefix}:pending") or 0):
+                break
+        return {"status": "ran", "runs": runs, "coalesced": coalesced}
+
+
+class DirtySet:
+    # Services whose stage-1 data changed and whose forecast has not been
+    # ingested since. Members are only removed after a successful ingest, so a
+    # service that fails in stage 2 or 3 is retried on the next run.
+    def __init__(self, client, key: str):
+        self.client = client
+        self.key = key
+
+    def add(self, service_ids):
+        if service_ids:
+            self.client.sadd(self.key, *service_ids)
+
+    def discard(self, service_ids):
+        if service_ids:
+            self.client.srem(self.key, *service_ids)
+
+    def members(self) -> set:
+        return {member.decode() for member in self.client.smembers(self.key)}
@@ -1,6 +1,34 @@
 import typing as T
 
-class Metrics(T.TypedDict):
+class Stats(T.TypedDict):
+    count: int
+    min: T.Optional[float]
+    max: T.Optional[float]
+    avg: T.Optional[float]
+    sum: float
+
+# Keyed "p25", "p50", ..., one per aggregation.PERCENTILES entry
+Percentiles = T.Dict[str, T.Optional[float]]
+
+class HourlyMetrics(T.TypedDict):
+    ts: int
+    ts_iso: str
+    dow: int
+    weekend: bool
+    occurences: int
+    latency_stats: Stats
+    latency_percentiles: Percentiles
+    request_size_stats: Stats
+    response_size_stats: Stats
+
+class Stage1Output(T.TypedDict):
+    id: str
+    name: str
+    data: T.List[HourlyMetrics]
+
+# Scores of the default models; other engines in models.ENGINES add
+# mae_<name>, mse_<name> and r2_<name> the same way
+class Metrics(T.TypedDict, total=False):
     mae_linear: float
     mse_linear: float
     r2_linear: float
@@ -15,8 +43,35 @@ class PredictRange(T.TypedDict):
     per_day: float
     per_hour: float
 
+class ModelTiming(T.TypedDict):
+    fit_s: float
+    predict_s: float
+
+# With the default models; every engine adds a <target>_<name> column per target
+class ForecastPoint(T.TypedDict, total=False):
+    ts_iso: str
+    ts: float
+    dow: int
+    weekend: bool
+    latency: T.Optional[float]
+    latency_random_forest: float
+    latency_linear: float
+    latency_p50: T.Optional[float]
+    latency_p50_random_forest: float
+    latency_p50_linear: float
+    latency_p90: T.Optional[float]
+    latency_p90_random_forest: float
+    latency_p90_linear: float
+    latency_p99: T.Optional[float]
+    latency_p99_random_forest: float
+    latency_p99_linear: float
+
 class PredictOutput(T.TypedDict):
     metrics: Metrics
+    targets: T.List[str]
+    target_metrics: T.Dict[str, Metrics]
+    models: T.List[str]
+    model_timings: T.Dict[str, ModelTiming]
     predict_range: PredictRange
     ts_unit: str
-    data: T.List[T.Dict]
\ No newline at end of file
+    data: T.List[ForecastPoint]
\ No newline at end of file
@@ -1,20 +1,126 @@
 
 import utils
-from celery import shared_task
+from celery import shared_task, chord
 
 @shared_task
 def run_pipeline(stages: list[int] = []):
+    if utils.COORDINATOR is None:
+        return execute_pipeline(stages)
+
+    if not len(stages) and utils.PIPELINE_MODE == "fanout":
+        # The lock outlives this task and is released by collect_pipeline.
+        # Until then it is renewed by whichever task of the run is working:
+        # this one during stage 1, then every process_service. If the run
+        # dies, nothing renews it and it expires after RUN_LOCK_LEASE.
+        lock = utils.COORDINATOR.lock()
+        if not lock.acquire():
+            pending = utils.COORDINATOR.request()
+            utils.RECORDER.count("runs_total", outcome="coalesced")
+            print("Pipeline already running, coalesced", pending, "start(s)")
+            return
+        utils.COORDINATOR.take_pending()
+        utils.COORDINATOR.report("started")
+        utils.RECORDER.count("runs_total", outcome="started")
+        lock.start_renewing()
+        try:
+            return execute_pipeline(stages, lock.token)
+        except Exception:
+            lock.release()
+            raise
+        finally:
+            lock.stop_renewing()
+
+    outcome = utils.COORDINATOR.run(lambda: execute_pipeline(stages))
+    if outcome["status"] == "coalesced":
+        utils.RECORDER.count("runs_total", outcome="coalesced")
+        print("Pipeline already running, coalesced", outcome["pending"], "start(s)")
+    else:
+        utils.RECORDER.count("runs_total", outcome["runs"], outcome="started")
+        print(
+            "Pipeline ran",
+            outcome["runs"],
+            "time(s), covering",
+            outcome["coalesced"],
+            "coalesced start(s)",
+        )
+    print("run totals:", utils.COORDINATOR.stats())
+    utils.RECORDER.flush()
+
+
+def execute_pipeline(stages: list[int], lock_token: str = None):
     pipe_stages = [
         utils.stage_1,
         utils.stage_2,
         utils.stage_3,
     ]
+    if not len(stages) and utils.PIPELINE_MODE == "fanout":
+        print("Run full pipeline, fanned out per service")
+        # Subtasks only get ids, so they need the stage-1 checkpoint on disk
+        service_ids = list(utils.stage_1(checkpoint=True))
+        return chord(
+            process_service.s(service_id, lock_token) for service_id in service_ids
+        )(collect_pipeline.s(lock_token)).id
+    # Results flow from stage to stage in process. A stage whose predecessor
+    # did not run in this call loads the last checkpoint from disk instead.
+    results = None
     if not len(stages):
         print("Run full pipeline")
         for pipe_stage in pipe_stages:
-            pipe_stage()
+            results = pipe_stage(results, checkpoint=utils.PIPELINE_CHECKPOINT)
     else:
         print("Run specific stages")
+        last_stage = None
         for stage in stages:
-            pipe_stages[stage - 1]()
+            results = pipe_stages[stage - 1](
+                results if last_stage == stage - 1 else None,
+                checkpoint=utils.PIPELINE_CHECKPOINT,
+            )
+            last_stage = stage
+
+
+# Runs stage 2 and 3 for one service. Errors are returned instead of raised so
+# that one broken service does not fail the whole chord.
+@shared_task
+def process_service(service_id: str, lock_token: str = None):
+    lock = None
+    if lock_token is not None:
+        lock = utils.COORDINATOR.lock(lock_token)
+        lock.start_renewing()
+    try:
+        if utils.predict_service(service_id).frame is None:
+            raise RuntimeError("prediction failed")
+        utils.ingest_service(service_id)
+    except Exception as err:
+        return {
+            "id": service_id,
+            "status": "error",
+            "error": f"{err.__class__.__name__}: {err}",
+        }
+    finally:
+        if lock is not None:
+            lock.stop_renewing()
+        utils.RECORDER.flush()
+    return {
+        "id": service_id,
+        "status": "ok",
+        "artifact": utils.ARTIFACTS.path(service_id, "stage-2"),
+    }
+
+
+@shared_task
+def collect_pipeline(results: list[dict], lock_token: str = None):
+    utils.MODEL_CACHE.evict()
+    failed = [result for result in results if result["status"] != "ok"]
+    print("processed services:", len(results) - len(failed))
+    for result in failed:
+        print("failed service:", result["id"], result["error"])
+
+    if lock_token is not None:
+        lock = utils.COORDINATOR.lock(lock_token)
+        if not lock.release():
+            print("run lock expired before the pipeline finished")
+        # Starts that were skipped while this run was going on get one new run
+        if utils.COORDINATOR.take_pending():
+            run_pipeline.delay()
 
+    return {"processed": len(results) - len(failed), "failed": failed}
@@ -0,0 +1,27 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import aggregation
+
+
+def test_transport_error_fails_only_its_batch(monkeypatch):
+    def fetch_batch(client, index, engine, batch, on_took):
+        if "b" in batch:
+            raise ConnectionError("msearch failed")
+        return {service_id: [] for service_id in batch}, {}
+
+    monkeypatch.setattr(aggregation, "fetch_batch", fetch_batch)
+    results, errors = aggregation.fetch_services(
+        None,
+        "kong-log",
+        "terms",
+        {"a": None, "b": None, "c": None, "d": None},
+        batch_size=2,
+        concurrency=2,
+    )
+
+    assert set(results) == {"c", "d"}
+    assert set(errors) == {"a", "b"}
+    assert all(isinstance(error, ConnectionError) for error in errors.values())
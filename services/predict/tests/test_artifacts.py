@@ -0,0 +1,50 @@
+import os
+import sys
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import artifacts
+import features
+
+HOUR_MS = 3600 * 1000
+
+
+def records(hours):
+    # Newest first, like the aggregation output; one bucket without percentiles
+    return [
+        {
+            "ts": 1700000000000 + hour * HOUR_MS,
+            "ts_iso": f"hour {hour}",
+            "dow": 1,
+            "weekend": False,
+            "latency_stats": {"avg": 10.0 + hour},
+            "latency_percentiles": {
+                "p50": None if hour == 0 else 5.0,
+                "p90": None,
+                "p99": None,
+            },
+        }
+        for hour in reversed(range(hours))
+    ]
+
+
+def test_nullable_numeric_columns_survive_npz(tmp_path):
+    frame = artifacts.to_frame(records(3))
+    assert frame["latency_percentiles.p90"].dtype == np.float64
+    assert frame["ts_iso"].dtype == object
+
+    store = artifacts.ArtifactStore(str(tmp_path), format="npz")
+    store.save("svc", "stage-1", {"id": "svc"}, frame)
+    _, loaded = store.load("svc", "stage-1")
+
+    assert loaded["latency_percentiles.p90"].dtype == np.float64
+    assert loaded["latency_percentiles.p90"].isna().all()
+    assert list(loaded["ts_iso"]) == ["hour 2", "hour 1", "hour 0"]
+    # Unchanged history compares equal, so the service is not marked dirty
+    assert loaded.equals(frame)
+
+    X, Y = features.history_columns(loaded)
+    assert X.dtype == Y.dtype == np.float64
+    assert np.isnan(Y[:, 2:]).all()
+    assert np.isnan(Y[-1, 1]) and Y[0, 1] == 5.0
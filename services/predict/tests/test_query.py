@@ -0,0 +1,36 @@
+import os
+import sys
+import importlib
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+pytest.importorskip("flask")
+
+HOUR_MS = 3600 * 1000
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    # query.py loads from ./output and writes ./metrics on import
+    monkeypatch.chdir(tmp_path)
+    query = importlib.import_module("query")
+    ts = np.array([0.0, HOUR_MS])
+    forecast = query.Forecast(
+        ts, ts + HOUR_MS, {"latency_linear": np.array([1.0, 2.0])}, {"latency": "linear"}, {}, 0
+    )
+    monkeypatch.setattr(query, "snapshot", query.Snapshot({"svc": forecast}, 1, 0))
+    return query.app.test_client()
+
+
+@pytest.mark.parametrize("args", ["t=", "t=abc", "t=nan", "start=x", "start=0&end=soon"])
+def test_malformed_parameters_are_rejected(client, args):
+    response = client.get(f"/forecast/svc?{args}")
+    assert response.status_code == 400
+    assert "error" in response.get_json()
+
+
+def test_point_and_range_lookups(client):
+    assert client.get(f"/forecast/svc?t={HOUR_MS + 1}").get_json()["value"] == 2.0
+    assert client.get("/forecast/svc?start=0&end=10").get_json()["values"] == [1.0]
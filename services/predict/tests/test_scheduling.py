@@ -0,0 +1,87 @@
+import os
+import sys
+import time
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+fakeredis = pytest.importorskip("fakeredis")
+
+from scheduling import RunLock, RunCoordinator
+
+
+@pytest.fixture
+def client():
+    return fakeredis.FakeRedis()
+
+
+def test_lock_is_exclusive_and_released_by_its_holder_only(client):
+    first = RunLock(client, "lock", lease_ms=1000)
+    second = RunLock(client, "lock", lease_ms=1000)
+    assert first.acquire()
+    assert not second.acquire()
+
+    second.token = "someone else"
+    assert not second.release()
+    assert client.get("lock") is not None
+
+    assert first.release()
+    assert second.acquire()
+
+
+def test_lock_expires_unless_renewed(client):
+    lock = RunLock(client, "lock", lease_ms=300)
+    assert lock.acquire()
+    lock.start_renewing()
+    time.sleep(0.8)
+    assert not RunLock(client, "lock", lease_ms=300).acquire()
+
+    lock.stop_renewing()
+    time.sleep(0.5)
+    assert RunLock(client, "lock", lease_ms=300).acquire()
+
+
+def test_handle_from_token_renews_and_releases(client):
+    coordinator = RunCoordinator(client, "predict", lease_ms=300)
+    lock = coordinator.lock()
+    assert lock.acquire()
+
+    handle = coordinator.lock(lock.token)
+    time.sleep(0.2)
+    assert handle.renew()
+    time.sleep(0.2)
+    assert client.get("predict:lock") is not None
+    assert handle.release()
+    assert client.get("predict:lock") is None
+
+
+def test_starts_during_a_run_are_coalesced_into_one_more_run(client):
+    coordinator = RunCoordinator(client, "predict", lease_ms=1000)
+    calls = []
+
+    def pipeline():
+        calls.append(len(calls))
+        if len(calls) == 1:
+            # Three starts while the first run holds the lock
+            for _ in range(3):
+                assert RunCoordinator(client, "predict", 1000).run(pipeline) == {
+                    "status": "coalesced",
+                    "pending": _ + 1,
+                }
+
+    outcome = coordinator.run(pipeline)
+    assert outcome == {"status": "ran", "runs": 2, "coalesced": 3}
+    assert calls == [0, 1]
+    assert coordinator.stats() == {"started": 2, "coalesced": 3}
+    assert client.get("predict:lock") is None
+
+
+def test_lock_is_released_when_the_run_fails(client):
+    coordinator = RunCoordinator(client, "predict", lease_ms=1000)
+
+    def pipeline():
+        raise RuntimeError("stage failed")
+
+    with pytest.raises(RuntimeError):
+        coordinator.run(pipeline)
+    assert client.get("predict:lock") is None
@@ -1,25 +1,69 @@
 import os
 import math
 import json
-import psycopg2
+import redis
 import numpy as np
 import pandas as pd
-from elasticsearch import Elasticsearch
-from datetime import datetime, timedelta
-from sklearn.linear_model import LinearRegression
-from sklearn.ensemble import RandomForestRegressor
-from sklearn.model_selection import train_test_split
+from elasticsearch import Elasticsearch, helpers
+from datetime import datetime, timedelta, timezone
 from sklearn import metrics
 from schema import PredictOutput
-
+import aggregation
+import artifacts
+import features
+import models
+from model_cache import ModelCache
+from instrumentation import Recorder
+from scheduling import RunCoordinator, DirtySet
+from registry import ServiceRegistry, PostgresSource, SnapshotSource
+
+REDIS_URL = os.environ.get("REDIS_URL", None)
 ELASTICSEARCH_INDEX = os.environ.get("ELASTICSEARCH_INDEX", None)
 ELASTICSEARCH_CONFIG = os.environ.get("ELASTICSEARCH_CONFIG", "{}")
 POSTGRES_CONFIG = os.environ.get("POSTGRES_CONFIG", "{}")
+REGISTRY_TTL = os.environ.get("REGISTRY_TTL", '{"minutes": 5}')
+REGISTRY_INVALIDATION = os.environ.get("REGISTRY_INVALIDATION", "updated_at")
+REGISTRY_CHANNEL = os.environ.get("REGISTRY_CHANNEL", "kong_services")
+REGISTRY_SNAPSHOT = os.environ.get("REGISTRY_SNAPSHOT", "")
+REGISTRY_POOL_SIZE = int(os.environ.get("REGISTRY_POOL_SIZE", "2"))
 PREDICT_RANGE = os.environ.get("PREDICT_RANGE", '{"days": 7}')
+PREDICT_MODELS = os.environ.get("PREDICT_MODELS", '["random_forest", "linear"]')
+PREDICT_SERVICE_MODELS = os.environ.get("PREDICT_SERVICE_MODELS", "{}")
+OUTPUT_RESOLUTION = os.environ.get(
+    "OUTPUT_RESOLUTION",
+    '[{"within": {"days": 14}, "hours": 1}, {"within": {"days": 90}, "hours": 24}]',
+)
+POINTS_INDEX = os.environ.get("POINTS_INDEX", "predict-points")
+AGGREGATION_ENGINE = os.environ.get("AGGREGATION_ENGINE", "composite")
+ROLLUP_INDEX = os.environ.get("ROLLUP_INDEX", "kong-rollup")
+FETCH_MODE = os.environ.get("FETCH_MODE", "batched")
+FETCH_BATCH_SIZE = int(os.environ.get("FETCH_BATCH_SIZE", "50"))
+FETCH_CONCURRENCY = int(os.environ.get("FETCH_CONCURRENCY", "4"))
+PIPELINE_MODE = os.environ.get("PIPELINE_MODE", "serial")
+PIPELINE_CHECKPOINT = os.environ.get("PIPELINE_CHECKPOINT", "true") == "true"
+RUN_LOCK = os.environ.get("RUN_LOCK", "true") == "true"
+RUN_LOCK_LEASE = os.environ.get("RUN_LOCK_LEASE", '{"minutes": 5}')
+DIRTY_TRACKING = os.environ.get("DIRTY_TRACKING", "true") == "true"
+MODEL_CACHE_KEY = os.environ.get("MODEL_CACHE_KEY", "buckets")
+MODEL_CACHE_MAX_MB = int(os.environ.get("MODEL_CACHE_MAX_MB", "4096"))
+MODEL_CACHE_MAX_AGE = os.environ.get("MODEL_CACHE_MAX_AGE", '{"days": 1}')
+ARTIFACT_FORMAT = os.environ.get("ARTIFACT_FORMAT", "npz")
+ARTIFACT_EXPORT = os.environ.get("ARTIFACT_EXPORT", "")
+INGEST_CONFIG = os.environ.get(
+    "INGEST_CONFIG",
+    '{"chunk_size": 500, "max_retries": 3, "initial_backoff": 2, "max_backoff": 60}',
+)
 
 ELASTICSEARCH_CONFIG = json.loads(ELASTICSEARCH_CONFIG)
 POSTGRES_CONFIG = json.loads(POSTGRES_CONFIG)
 PREDICT_RANGE = json.loads(PREDICT_RANGE)
+PREDICT_MODELS = json.loads(PREDICT_MODELS)
+PREDICT_SERVICE_MODELS = json.loads(PREDICT_SERVICE_MODELS)
+OUTPUT_RESOLUTION = json.loads(OUTPUT_RESOLUTION)
+MODEL_CACHE_MAX_AGE = json.loads(MODEL_CACHE_MAX_AGE)
+INGEST_CONFIG = json.loads(INGEST_CONFIG)
+RUN_LOCK_LEASE = json.loads(RUN_LOCK_LEASE)
+REGISTRY_TTL = json.loads(REGISTRY_TTL)
 
 
 def check_config(config: dict, fields: list):
@@ -31,25 +75,113 @@ def check_config(config: dict, fields: list):
 
 assert ELASTICSEARCH_INDEX
 assert check_config(ELASTICSEARCH_CONFIG, ["hosts"])
-assert check_config(POSTGRES_CONFIG, ["user", "password", "host", "port"])
-
-USER, PASSWORD, HOST, PORT = (
-    POSTGRES_CONFIG.pop("user"),
-    POSTGRES_CONFIG.pop("password"),
-    POSTGRES_CONFIG.pop("host"),
-    POSTGRES_CONFIG.pop("port"),
+# Without Postgres, the services are read from a Kong snapshot only
+assert REGISTRY_SNAPSHOT or check_config(
+    POSTGRES_CONFIG, ["user", "password", "host", "port"]
+)
+assert REGISTRY_INVALIDATION in ["updated_at", "notify", "ttl"]
+assert AGGREGATION_ENGINE in aggregation.ENGINES
+assert FETCH_MODE in ["batched", "serial"]
+assert PIPELINE_MODE in ["serial", "fanout"]
+assert OUTPUT_RESOLUTION and all(
+    check_config(resolution, ["within", "hours"]) for resolution in OUTPUT_RESOLUTION
+)
+assert all(
+    name in models.ENGINES
+    for names in [PREDICT_MODELS, *PREDICT_SERVICE_MODELS.values()]
+    for name in names
 )
 
 DATA_DIR = "output"
+METRICS_DIR = os.environ.get("METRICS_DIR", "metrics")
+METRICS_JSONL_MAX_MB = int(os.environ.get("METRICS_JSONL_MAX_MB", "64"))
 
-POSTGRES_URL = f"postgres://{USER}:{PASSWORD}@{HOST}:{PORT}"
+POSTGRES_URL = None
 
-if POSTGRES_CONFIG:
-    POSTGRES_URL += "&".join(
-        [f"{key}={POSTGRES_CONFIG[key]}" for key in POSTGRES_CONFIG]
+if check_config(POSTGRES_CONFIG, ["user", "password", "host", "port"]):
+    USER, PASSWORD, HOST, PORT = (
+        POSTGRES_CONFIG.pop("user"),
+        POSTGRES_CONFIG.pop("password"),
+        POSTGRES_CONFIG.pop("host"),
+        POSTGRES_CONFIG.pop("port"),
     )
 
-PERCENTILES = [25, 50, 75, 80, 85, 90, 99]
+    POSTGRES_URL = f"postgres://{USER}:{PASSWORD}@{HOST}:{PORT}"
+
+    if POSTGRES_CONFIG:
+        POSTGRES_URL += "&".join(
+            [f"{key}={POSTGRES_CONFIG[key]}" for key in POSTGRES_CONFIG]
+        )
+
+PERCENTILES = aggregation.PERCENTILES
+
+ARTIFACTS = artifacts.ArtifactStore(
+    DATA_DIR,
+    format=ARTIFACT_FORMAT,
+    exports=[export for export in ARTIFACT_EXPORT.split(",") if export],
+)
+
+RECORDER = Recorder(METRICS_DIR, max_jsonl_bytes=METRICS_JSONL_MAX_MB * 1024 * 1024)
+
+MODEL_CACHE = ModelCache(
+    DATA_DIR,
+    max_bytes=MODEL_CACHE_MAX_MB * 1024 * 1024,
+    max_age=timedelta(**MODEL_CACHE_MAX_AGE).total_seconds(),
+    key=MODEL_CACHE_KEY,
+)
+
+# Run lock and dirty tracking need a shared Redis. With the in-memory broker
+# everything runs in one process, so they are left out.
+COORDINATOR = None
+DIRTY = None
+if REDIS_URL and REDIS_URL.startswith("redis"):
+    _redis = redis.Redis.from_url(REDIS_URL)
+    if RUN_LOCK:
+        COORDINATOR = RunCoordinator(
+            _redis,
+            "predict",
+            lease_ms=int(timedelta(**RUN_LOCK_LEASE).total_seconds() * 1000),
+        )
+    if DIRTY_TRACKING:
+        DIRTY = DirtySet(_redis, "predict:dirty")
+
+# Kong's services table first, the snapshot when the database is unreachable
+_registry_sources = []
+if POSTGRES_URL:
+    _registry_sources.append(
+        PostgresSource(
+            POSTGRES_URL,
+            pool_size=REGISTRY_POOL_SIZE,
+            versioned=REGISTRY_INVALIDATION != "ttl",
+        )
+    )
+if REGISTRY_SNAPSHOT:
+    _registry_sources.append(SnapshotSource(REGISTRY_SNAPSHOT))
+
+# The listener is started by the registry in each worker process that uses it
+_registry_watch = None
+if POSTGRES_URL and REGISTRY_INVALIDATION == "notify":
+    _registry_watch = lambda callback: _registry_sources[0].listen(
+        REGISTRY_CHANNEL, callback
+    )
+
+REGISTRY = ServiceRegistry(
+    _registry_sources,
+    ttl=timedelta(**REGISTRY_TTL).total_seconds(),
+    watch=_registry_watch,
+)
+
+_es_client = None
+
+
+# One client per worker process, so its connection pool is reused across runs
+def get_es_client():
+    global _es_client
+    if _es_client is None:
+        _es_client = Elasticsearch(
+            **{"connections_per_node": FETCH_CONCURRENCY, **ELASTICSEARCH_CONFIG}
+        )
+    return _es_client
 
 
 def pipeline_stage(stage_name: str):
@@ -57,273 +189,527 @@ def pipeline_stage(stage_name: str):
         def inner(*args, **kwargs):
             print("---------------------------------------------------------------")
             print("start_stage:", stage_name)
-            func(*args, **kwargs)
-            try:
-                pass
-            except Exception as err:
-                print("encounter error:", err.__class__.__name__)
-                print("full detail:", err)
+            result = None
+            with RECORDER.timer("stage", stage=stage_name):
+                try:
+                    result = func(*args, **kwargs)
+                except Exception as err:
+                    RECORDER.count("stage_errors_total", stage=stage_name)
+                    print("encounter error:", err.__class__.__name__)
+                    print("full detail:", err)
+            RECORDER.flush()
             print("end_stage:", stage_name)
             print("---------------------------------------------------------------")
+            return result
 
         return inner
 
     return wrapper
 
 
-@pipeline_stage("get data")
-def stage_1():
-    def enrich(record):
-        _ts = datetime.fromisoformat(record["key_as_string"])
-        _output = {}
-        _output["ts"] = record["key"]
-        _output["ts_iso"] = record["key_as_string"]
-        _output["dow"] = _ts.isoweekday()
-        _output["weekend"] = _ts.isoweekday in [6, 7]
-        _output["occurences"] = record["doc_count"]
-        for key in record:
-            if key not in ["key", "key_as_string", "doc_count"]:
-                _output[key] = record[key]
-        return _output
-
-    conn = psycopg2.connect(POSTGRES_URL)
-    output = {}
+# The watermark is the key of the newest hour bucket fetched so far. That bucket
+# may still have been filling up at the time, so the next run queries from the
+# watermark onwards (inclusive) and replaces it.
+# The latest history of every service is also kept in process, so that runs
+# without checkpoints still only fetch new buckets.
+_histories = {}
+
+
+def load_history(service_id):
+    if service_id in _histories:
+        return _histories[service_id]
     try:
-        client = Elasticsearch(**ELASTICSEARCH_CONFIG)
-        cursor = conn.cursor()
-        cursor.execute("SELECT id, name, host FROM services")
-        services = cursor.fetchall()
+        with open(f"{DATA_DIR}/{service_id}/new_metrics/watermark.json", "r") as file:
+            watermark = json.load(file)["ts"]
+        _, history = ARTIFACTS.load(service_id, "stage-1")
+    except (OSError, ValueError, KeyError):
+        return None, None
+    # Stored before all forecast targets were fetched: refetch everything once
+    if not features.has_targets(history):
+        return None, None
+    return history, watermark
+
+
+def save_history(service_id, meta, history, watermark, checkpoint=True):
+    _histories[service_id] = (history, watermark)
+    if not checkpoint:
+        return
+    ARTIFACTS.save(service_id, "stage-1", meta, history)
+    # Written after the history so that a crash in between only causes a refetch
+    with open(f"{DATA_DIR}/{service_id}/new_metrics/watermark.json", "w") as file:
+        json.dump({"ts": watermark}, file)
+
+
+# Whether the refetched buckets differ from the stored ones they replace
+def history_changed(history, fresh, watermark):
+    if history is None or watermark is None:
+        return True
+    stored = history[history["ts"] >= watermark].reset_index(drop=True)
+    return not stored.equals(fresh.reset_index(drop=True))
+
+
+def merge_history(history, fresh, watermark):
+    # Both frames are ordered newest first, like the aggregation output
+    if watermark is None:
+        return fresh
+    return pd.concat(
+        [fresh, history[history["ts"] < watermark]], ignore_index=True
+    )
 
-        for service in services[:]:
-            _query = {"bool": {"must": {"match": {"service.id": service[0]}}}}
-            _runtime_mappings = {
-                "hour_truncated_time": {
-                    "type": "date",
-                    "script": """
-                            ZonedDateTime truncatedDateTime = doc['@timestamp'].value.truncatedTo(ChronoUnit.HOURS);
-                            long miliTimestamp = truncatedDateTime.toEpochSecond() * 1000;
-                            emit(miliTimestamp);
-                        """,
-                },
-            }
-            _fields = ["hour_truncated_time"]
-            _aggs = {
-                "aggs": {
-                    "terms": {
-                        "size": 10000,
-                        "field": "hour_truncated_time",
-                        "order": {"_key": "desc"},
-                    },
-                    "aggs": {
-                        "latency_stats": {"stats": {"field": "latencies.request"}},
-                        "request_size_stats": {"stats": {"field": "request.size"}},
-                        "response_size_stats": {"stats": {"field": "response.size"}},
-                    },
-                },
-            }
 
-            data = client.search(
-                index=ELASTICSEARCH_INDEX,
-                query=_query,
-                runtime_mappings=_runtime_mappings,
-                fields=_fields,
-                size=0,
-                aggs=_aggs,
-            ).body
+def record_took(service_id, took):
+    RECORDER.observe("es_took_seconds", took / 1000, service=service_id)
+    RECORDER.emit("es_search", service=service_id, took_ms=took)
 
-            os.makedirs(f"{DATA_DIR}/{service[0]}/new_metrics", exist_ok=True)
 
-            raw_aggregations = data["aggregations"]["aggs"]["buckets"]
-            aggregated_data = [enrich(record) for record in raw_aggregations]
+# The rollup engine reads what services/rollup wrote instead of the raw logs
+FETCH_INDEX = ROLLUP_INDEX if AGGREGATION_ENGINE == "rollup" else ELASTICSEARCH_INDEX
 
-            output = {
-                "id": service[0],
-                "name": service[1],
-                "data": aggregated_data,
-            }
 
-            with open(f"{DATA_DIR}/{service[0]}/new_metrics/stage-1.json", "w") as file:
-                json.dump(
-                    output,
-                    file,
-                    indent=2,
+def fetch_metrics(client, watermarks):
+    if FETCH_MODE == "batched":
+        return aggregation.fetch_services(
+            client,
+            FETCH_INDEX,
+            AGGREGATION_ENGINE,
+            watermarks,
+            batch_size=FETCH_BATCH_SIZE,
+            concurrency=FETCH_CONCURRENCY,
+            on_took=record_took,
+        )
+    results = {}
+    errors = {}
+    for service_id, watermark in watermarks.items():
+        try:
+            results[service_id] = aggregation.fetch_buckets(
+                client,
+                FETCH_INDEX,
+                AGGREGATION_ENGINE,
+                service_id,
+                since=watermark,
+                on_took=record_took,
+            )
+        except Exception as err:
+            errors[service_id] = err
+    return results, errors
+
+
+# Every stage takes the previous stage's results (None to load them from the
+# last checkpoint on disk) and returns its own as {service_id: Artifact}.
+# Checkpoints are only written when `checkpoint` is set.
+@pipeline_stage("get data")
+def stage_1(previous=None, checkpoint=True):
+    results = {}
+    changed = []
+    try:
+        client = get_es_client()
+        services = REGISTRY.services()
+
+        histories = {service[0]: load_history(service[0]) for service in services}
+        raw_aggregations, errors = fetch_metrics(
+            client,
+            {service_id: histories[service_id][1] for service_id in histories},
+        )
+        for service_id in errors:
+            print("Failed to fetch", service_id, errors[service_id])
+
+        for service in services[:]:
+            with RECORDER.timer(
+                "service", stage="get data", service=service[0]
+            ) as timing:
+                meta = {"id": service[0], "name": service[1]}
+                history, watermark = histories[service[0]]
+                if history is not None:
+                    results[service[0]] = artifacts.Artifact(meta, history)
+                if service[0] not in raw_aggregations:
+                    continue
+
+                aggregated_data = artifacts.to_frame(
+                    [
+                        aggregation.enrich(record)
+                        for record in raw_aggregations[service[0]]
+                    ]
+                )
+                timing["rows"] = len(aggregated_data)
+                if not len(aggregated_data) and watermark is not None:
+                    continue
+                if history_changed(history, aggregated_data, watermark):
+                    changed.append(service[0])
+
+                aggregated_data = merge_history(history, aggregated_data, watermark)
+
+                save_history(
+                    service[0],
+                    meta,
+                    aggregated_data,
+                    int(aggregated_data["ts"].iloc[0]) if len(aggregated_data) else None,
+                    checkpoint=checkpoint,
                 )
+                results[service[0]] = artifacts.Artifact(meta, aggregated_data)
 
     except Exception as err:
         print("Encountered", err.__class__.__name__)
         print(err)
 
-    finally:
-        conn.close()
+    # Only services with new data, or whose last update has not been ingested
+    # yet, move on to the next stages
+    if DIRTY is not None:
+        DIRTY.add(changed)
+        dirty = DIRTY.members()
+        print("dirty services:", len(dirty & set(results)), "of", len(results))
+        results = {
+            service_id: results[service_id]
+            for service_id in results
+            if service_id in dirty
+        }
+    return results
 
 
-@pipeline_stage("predict timeseries")
-def stage_2():
-    def to_date(ts: float):
-        return datetime.fromtimestamp(ts / 1000)
-
-    def get_X(record):
-        return (
-            record["ts"],
-            record["dow"],
-            record["weekend"],
-        )
+# Time-ordered holdout: the oldest two thirds train, the newest third tests, so
+# no test hour has neighbours on both sides of it in the training data
+def get_Xy(X, y, test_size=1 / 3):
+    order = np.argsort(X[:, 0], kind="stable")
+    X, y = X[order], y[order]
+    split = len(X) - int(len(X) * test_size)
 
-    def get_Y(record):
-        return record["latency_stats"]["avg"]
+    return X[:split], X[split:], y[:split], y[split:]
 
-    def get_Xy(data):
-        def get_data():
-            samp_ = []
-            feat_ = []
-            for record in data:
-                samp_.append(get_X(record))
-                feat_.append(get_Y(record))
-            return samp_, feat_
 
-        X_train, X_test, y_train, y_test = train_test_split(
-            *get_data(), test_size=1 / 3, random_state=0
-        )
+def nan_to_none(value):
+    return value if not math.isnan(value) else None
 
-        return X_train, X_test, y_train, y_test
-    
-    def process(service_id):
+
+def service_models(service_id):
+    return PREDICT_SERVICE_MODELS.get(service_id, PREDICT_MODELS)
+
+
+def score(actual, predicted, model):
+    return {
+        f"mae_{model}": nan_to_none(metrics.mean_absolute_error(actual, predicted)),
+        f"mse_{model}": nan_to_none(metrics.mean_squared_error(actual, predicted)),
+        f"r2_{model}": nan_to_none(metrics.r2_score(actual, predicted)),
+    }
+
+
+def predict_service(service_id, data=None, checkpoint=True):
+    with RECORDER.timer(
+        "service", stage="predict timeseries", service=service_id
+    ) as timing:
         output = PredictOutput({})
+        df = None
         try:
-            data = []
-            with open(f"{DATA_DIR}/{service_id}/new_metrics/stage-1.json", "r") as file:
-                data = json.load(file)["data"]
-
-            train_samples, _, train_features, _ = get_Xy(data)
+            if data is None:
+                _, data = ARTIFACTS.load(service_id, "stage-1")
 
-            org_ts = {point["ts"]: idx for idx, point in enumerate(data)}
+            history_X, history_Y = features.history_columns(data)
+            train_samples, test_samples, train_features, test_features = get_Xy(
+                history_X, history_Y
+            )
 
-            # TODO: Limit the output so that the payload is not too big
-            ext_start_range = to_date(data[-1]["ts"])
             ext_predict_range = timedelta(**PREDICT_RANGE)
-            ext_end_range = datetime.utcnow() + ext_predict_range
-
-            ext_date_range = pd.date_range(
-                ext_start_range,
-                ext_end_range,
-                freq="h",
+            ext_end_range = datetime.now(timezone.utc) + ext_predict_range
+            df = features.forecast_frame(
+                history_X[-1, 0],
+                ext_end_range.timestamp() * 1000,
+                history_X[:, 0],
+                history_Y,
             )
-            test_samples = []
-            test_features = []
-            ext_samples = []
-            ext_features = []
-            for idx, ext_date in enumerate(ext_date_range):
-                _sample = get_X(
-                    {
-                        "ts": ext_date.timestamp() * 1000,
-                        "dow": ext_date.isoweekday(),
-                        "weekend": ext_date.isoweekday() in [6, 7],
-                    }
-                )
-                _feature = None
-                if _sample[0] in org_ts:
-                    org_idx = org_ts[_sample[0]]
-                    _feature = get_Y(data[org_idx])
-                    test_samples.append(_sample)
-                    test_features.append(_feature)
-                ext_samples.append(_sample)
-                ext_features.append(_feature)
+            ext_samples = features.samples(df)
+            targets = list(features.TARGETS)
 
             output["ts_unit"] = "ms"
             output["predict_range"] = {
-                "start": data[-1]["ts"],
-                "current": data[0]["ts"],
-                "end": ext_samples[-1][0],
+                "start": int(history_X[-1, 0]),
+                "current": int(history_X[0, 0]),
+                "end": float(ext_samples[-1][0]),
                 "per_day": timedelta(days=1).total_seconds() * 1000,
                 "per_hour": timedelta(hours=1).total_seconds() * 1000,
             }
-
-            rfr = RandomForestRegressor(200).fit(train_samples, train_features)
-            lr = LinearRegression().fit(train_samples, train_features)
-            rfr_features = rfr.predict(ext_samples)
-            pred_features = [
-                rfr_features[idx]
-                for idx in range(len(ext_features))
-                if ext_features[idx] is not None
-            ]
-            rfr_mae = metrics.mean_absolute_error(test_features, pred_features)
-            rfr_mse = metrics.mean_squared_error(test_features, pred_features)
-            rfr_r2 = metrics.r2_score(test_features, pred_features)
-            lr_features = lr.predict(ext_samples)
-            pred_features = [
-                lr_features[idx]
-                for idx in range(len(ext_features))
-                if ext_features[idx] is not None
-            ]
-            lr_mae = metrics.mean_absolute_error(test_features, pred_features)
-            lr_mse = metrics.mean_squared_error(test_features, pred_features)
-            lr_r2 = metrics.r2_score(test_features, pred_features)
-
-            output["metrics"] = {
-                "mae_linear": lr_mae if not math.isnan(lr_mae) else None,
-                "mse_linear": lr_mse if not math.isnan(lr_mse) else None,
-                "r2_linear": lr_r2 if not math.isnan(lr_r2) else None,
-                "mae_random_forest": rfr_mae if not math.isnan(rfr_mae) else None,
-                "mse_random_forest": rfr_mse if not math.isnan(rfr_mse) else None,
-                "r2_random_forest": rfr_r2 if not math.isnan(rfr_r2) else None,
-            }
-            _df_data = []
-            for idx in range(len(ext_samples)):
-                _df_data.append(
-                    (
-                        to_date(ext_samples[idx][0]).isoformat(),
-                        *ext_samples[idx],
-                        ext_features[idx],
-                        rfr_features[idx] if rfr_features[idx] else 0,
-                        lr_features[idx] if lr_features[idx] else 0,
+            output["targets"] = targets
+            output["models"] = service_models(service_id)
+            output["model_timings"] = {}
+
+            # Every engine is multi-output: one fit covers all targets
+            predictions = {}
+            # Per model, the held-out actual values and what it predicted
+            holdout = {}
+            for name in output["models"]:
+                engine = models.ENGINES[name]
+                with RECORDER.timer("model_fit", service=service_id, model=name) as fit:
+                    if engine.online:
+                        # Updated in time order, so trained on the whole history
+                        model = MODEL_CACHE.get_or_update(
+                            service_id,
+                            name,
+                            engine.factory,
+                            engine.params,
+                            history_X,
+                            history_Y,
+                        )
+                    else:
+                        # The forecast comes from the whole history
+                        model = MODEL_CACHE.get_or_fit(
+                            service_id,
+                            name,
+                            engine.factory,
+                            engine.params,
+                            history_X,
+                            history_Y,
+                        )
+                if model is None:
+                    continue
+                with RECORDER.timer(
+                    "model_predict", service=service_id, model=name
+                ) as predict:
+                    predictions[name] = model.predict(ext_samples).reshape(len(df), -1)
+                # Scores come from a second model that has not seen the newest
+                # third, fitted in one go for online engines too so that every
+                # engine is scored on the same hours
+                if len(test_samples):
+                    with RECORDER.timer(
+                        "model_holdout", service=service_id, model=name
+                    ):
+                        scored = MODEL_CACHE.get_or_fit(
+                            service_id,
+                            f"holdout_{name}",
+                            engine.factory,
+                            engine.params,
+                            train_samples,
+                            train_features,
+                        )
+                        holdout[name] = (
+                            test_features,
+                            scored.predict(test_samples).reshape(len(test_samples), -1),
+                        )
+                output["model_timings"][name] = {
+                    "fit_s": fit["wall_s"],
+                    "predict_s": predict["wall_s"],
+                }
+
+            output["target_metrics"] = {}
+            for idx, target in enumerate(targets):
+                output["target_metrics"][target] = {}
+                for name, (actual, predicted) in holdout.items():
+                    has_actual = np.isfinite(actual[:, idx])
+                    if not has_actual.any():
+                        continue
+                    output["target_metrics"][target].update(
+                        score(actual[has_actual, idx], predicted[has_actual, idx], name)
                     )
-                )
-            df = pd.DataFrame(
-                data=_df_data,
-                columns=[
-                    "ts_iso",
-                    "ts",
-                    "dow",
-                    "weekend",
-                    "latency",
-                    "latency_random_forest",
-                    "latency_linear",
-                ],
-            )
-            df.to_csv(
-                f"{DATA_DIR}/{service_id}/new_metrics/stage-2.csv", header=True, index=False
+            # The average latency keeps its original place
+            output["metrics"] = output["target_metrics"]["latency"]
+
+            for idx, target in enumerate(targets):
+                for name in predictions:
+                    df[f"{target}_{name}"] = predictions[name][:, idx]
+            # Metrics above use the held-out hours; the output is bounded by the windows
+            df = features.downsample(
+                df, datetime.now(timezone.utc).timestamp() * 1000, OUTPUT_RESOLUTION
             )
-            output["data"] = df.replace([np.nan], None).to_dict(orient="records")
 
         except Exception as error:
             print("deliberately ignore", error)
+            df = None
 
         finally:
-            with open(
-                f"{DATA_DIR}/{service_id}/new_metrics/stage-2.json", 
-                "w"
-            ) as file:
-                json.dump(
-                    output,
-                    file,
-                    indent=None,
-                )
+            if checkpoint:
+                ARTIFACTS.save(service_id, "stage-2", output, df)
+        timing["rows"] = len(df) if df is not None else 0
 
-    for service_id in os.listdir(DATA_DIR)[:]:
-        process(service_id)
+    return artifacts.Artifact(output, df)
 
-@pipeline_stage("ingest to ES")
-def stage_3():
-    for service_id in os.listdir(DATA_DIR)[:]:
-        data = {}
+
+@pipeline_stage("predict timeseries")
+def stage_2(previous=None, checkpoint=True):
+    if previous is None:
+        previous = {service_id: None for service_id in os.listdir(DATA_DIR)}
+    results = {}
+    for service_id, artifact in previous.items():
+        results[service_id] = predict_service(
+            service_id,
+            artifact.frame if artifact is not None else None,
+            checkpoint=checkpoint,
+        )
+    MODEL_CACHE.evict()
+    cache_stats = MODEL_CACHE.stats()
+    for key in cache_stats:
+        RECORDER.gauge(f"model_cache_{key}", cache_stats[key])
+    print("model cache:", cache_stats)
+    return results
+
+
+def point_id(service_id, ts, resolution_h):
+    return f"{service_id}:{int(ts)}:{resolution_h}"
+
+
+def service_of(doc_id):
+    return doc_id.split(":", 1)[0]
+
+
+# Per service, a summary document (metrics, ranges, models) in `predict` and
+# one small document per forecast row in POINTS_INDEX. Point ids only depend on
+# the row's time and resolution, so a rerun overwrites instead of adding.
+def ingest_actions(service_ids, previous=None):
+    for service_id in service_ids:
+        meta, frame = {}, None
         try:
-            with open(f"{DATA_DIR}/{service_id}/new_metrics/stage-2.json", "r") as file:
-                data = json.load(file)
+            if previous is not None:
+                meta, frame = previous[service_id]
+            else:
+                meta, frame = ARTIFACTS.load(service_id, "stage-2")
         except Exception as error:
             print(error)
-        client = Elasticsearch(**ELASTICSEARCH_CONFIG)
-        client.index(
-            id=service_id,
-            index="predict",
-            document=data,
+        yield {
+            "_op_type": "index",
+            "_index": "predict",
+            "_id": service_id,
+            "_source": meta,
+        }
+        if frame is None or not len(frame.columns):
+            continue
+        for record in artifacts.to_records(frame):
+            point = {key: value for key, value in record.items() if value is not None}
+            yield {
+                "_op_type": "index",
+                "_index": POINTS_INDEX,
+                "_id": point_id(service_id, record["ts"], record["resolution_h"]),
+                "_source": {
+                    "@timestamp": int(record["ts"]),
+                    "service_id": service_id,
+                    **point,
+                },
+            }
+
+
+_points_index_ready = False
+
+
+def ensure_points_index(client):
+    global _points_index_ready
+    if _points_index_ready:
+        return
+    # 400 when another worker created it first
+    client.options(ignore_status=400).indices.create(
+        index=POINTS_INDEX,
+        mappings={
+            "properties": {
+                "@timestamp": {"type": "date", "format": "epoch_millis"},
+                "service_id": {"type": "keyword"},
+                "ts_iso": {"type": "date"},
+                "resolution_h": {"type": "short"},
+            }
+        },
+    )
+    _points_index_ready = True
+
+
+# Points that a window has since rolled up into a coarser resolution, or that
+# fell out of the last window
+def prune_points(client, service_ids):
+    edges = features.resolution_edges(
+        datetime.now(timezone.utc).timestamp() * 1000, OUTPUT_RESOLUTION
+    )
+    stale = [
+        {
+            "bool": {
+                "filter": [
+                    {"term": {"resolution_h": hours}},
+                    {"range": {"@timestamp": {"lt": int(older_than)}}},
+                ]
+            }
+        }
+        for hours, older_than in edges
+    ]
+    stale.append({"range": {"@timestamp": {"lt": int(edges[-1][1])}}})
+    response = client.delete_by_query(
+        index=POINTS_INDEX,
+        query={
+            "bool": {
+                "filter": [{"terms": {"service_id": list(service_ids)}}],
+                "should": stale,
+                "minimum_should_match": 1,
+            }
+        },
+        conflicts="proceed",
+    )
+    return response.body.get("deleted", 0)
+
+
+# Results come back in submission order, so every INGEST_CONFIG["chunk_size"]
+# consecutive results form one batch of the report
+def ingest_services(service_ids, previous=None):
+    chunk_size = INGEST_CONFIG.get("chunk_size", 500)
+    report = {"indexed": 0, "failed": 0, "pruned": 0, "batches": []}
+    client = get_es_client()
+    ensure_points_index(client)
+    for position, (ok, item) in enumerate(
+        helpers.streaming_bulk(
+            client,
+            ingest_actions(service_ids, previous),
+            raise_on_error=False,
+            raise_on_exception=False,
+            **INGEST_CONFIG,
         )
+    ):
+        if position % chunk_size == 0:
+            report["batches"].append({"batch": position // chunk_size, "errors": []})
+        if ok:
+            report["indexed"] += 1
+            continue
+        report["failed"] += 1
+        result = item.get("index", item)
+        report["batches"][-1]["errors"].append(
+            {
+                "id": result.get("_id"),
+                "status": result.get("status"),
+                "error": result.get("error", result.get("exception")),
+            }
+        )
+    report["batches"] = [batch for batch in report["batches"] if batch["errors"]]
+    if service_ids:
+        try:
+            report["pruned"] = prune_points(client, service_ids)
+        except Exception as error:
+            print("Failed to prune points", error)
+    return report
+
+
+def ingest_service(service_id):
+    report = ingest_services([service_id])
+    if report["failed"]:
+        raise RuntimeError(report["batches"][0]["errors"][0])
+    if DIRTY is not None:
+        DIRTY.discard([service_id])
+
+
+@pipeline_stage("ingest to ES")
+def stage_3(previous=None, checkpoint=True):
+    if previous is None:
+        service_ids = os.listdir(DATA_DIR)
+        report = ingest_services(service_ids)
+    else:
+        service_ids = list(previous)
+        report = ingest_services(service_ids, previous)
+    if DIRTY is not None:
+        failed = {
+            service_of(error["id"])
+            for batch in report["batches"]
+            for error in batch["errors"]
+        }
+        if previous is not None:
+            failed |= {
+                service_id
+                for service_id in previous
+                if previous[service_id].frame is None
+            }
+        DIRTY.discard(
+            [service_id for service_id in service_ids if service_id not in failed]
+        )
+    RECORDER.count("ingest_documents_total", report["indexed"], status="indexed")
+    RECORDER.count("ingest_documents_total", report["failed"], status="failed")
+    RECORDER.count("ingest_points_pruned_total", report["pruned"])
+    print(
+        "indexed:", report["indexed"], "failed:", report["failed"], "pruned:", report["pruned"]
+    )
+    for batch in report["batches"]:
+        print("batch", batch["batch"], "errors:", json.dumps(batch["errors"], default=str))
@@ -0,0 +1,176 @@
+import os
+import json
+import time
+import signal
+import asyncio
+from datetime import timedelta
+from elasticsearch import Elasticsearch, helpers
+from rollup import Aggregator, Rollup
+
+ELASTICSEARCH_CONFIG = os.environ.get("ELASTICSEARCH_CONFIG", "{}")
+ROLLUP_INDEX = os.environ.get("ROLLUP_INDEX", "kong-rollup")
+TCP_PORT = int(os.environ.get("TCP_PORT", "20001"))
+UDP_PORT = int(os.environ.get("UDP_PORT", "5555"))
+FLUSH_INTERVAL = float(os.environ.get("FLUSH_INTERVAL", "10"))
+GRACE_PERIOD = os.environ.get("GRACE_PERIOD", '{"minutes": 5}')
+SKETCH_ALPHA = float(os.environ.get("SKETCH_ALPHA", "0.01"))
+# Kong's tcp-log sends one JSON record per line
+MAX_LINE_BYTES = int(os.environ.get("MAX_LINE_BYTES", str(4 * 1024 * 1024)))
+
+ELASTICSEARCH_CONFIG = json.loads(ELASTICSEARCH_CONFIG)
+GRACE_PERIOD = json.loads(GRACE_PERIOD)
+
+assert "hosts" in ELASTICSEARCH_CONFIG
+
+AGGREGATOR = Aggregator(
+    grace_ms=int(timedelta(**GRACE_PERIOD).total_seconds() * 1000),
+    alpha=SKETCH_ALPHA,
+)
+
+# Keys whose stored rollup, if any, has already been merged into memory
+persisted = set()
+
+stats = {"flushes": 0, "flushed": 0, "merged": 0, "failed": 0}
+
+
+def now_ms():
+    return int(time.time() * 1000)
+
+
+class TcpProtocol(asyncio.Protocol):
+    def __init__(self):
+        self.buffer = b""
+
+    def data_received(self, data):
+        self.buffer += data
+        *lines, self.buffer = self.buffer.split(b"\n")
+        received = now_ms()
+        for line in lines:
+            add(line, received)
+        if len(self.buffer) > MAX_LINE_BYTES:
+            AGGREGATOR.counters["invalid"] += 1
+            self.buffer = b""
+
+    def eof_received(self):
+        if self.buffer.strip():
+            add(self.buffer, now_ms())
+        self.buffer = b""
+
+
+class UdpProtocol(asyncio.DatagramProtocol):
+    def datagram_received(self, data, addr):
+        add(data, now_ms())
+
+
+def add(line, received):
+    if not line.strip():
+        return
+    try:
+        record = json.loads(line)
+    except ValueError:
+        record = None
+    if not isinstance(record, dict):
+        AGGREGATOR.counters["invalid"] += 1
+        return
+    AGGREGATOR.add(record, received)
+
+
+def ensure_index(client):
+    # The sketch is only read back by this service, so it is not indexed
+    client.options(ignore_status=400).indices.create(
+        index=ROLLUP_INDEX,
+        mappings={
+            "properties": {
+                "@timestamp": {"type": "date", "format": "epoch_millis"},
+                "service_id": {"type": "keyword"},
+                "latency_sketch": {"type": "object", "enabled": False},
+            }
+        },
+    )
+
+
+def load_stored(client, rollups):
+    response = client.mget(index=ROLLUP_INDEX, ids=[rollup.id for rollup in rollups])
+    return {doc["_id"]: doc["_source"] for doc in response["docs"] if doc.get("found")}
+
+
+def write(client, documents):
+    failed = []
+    for ok, item in helpers.streaming_bulk(
+        client,
+        [
+            {"_index": ROLLUP_INDEX, "_id": doc_id, "_source": document}
+            for doc_id, document in documents
+        ],
+        raise_on_error=False,
+        max_retries=3,
+    ):
+        if not ok:
+            failed.append(item["index"]["_id"])
+    return failed
+
+
+# Every rollup that changed since the last flush is written whole, under
+# "<service id>:<hour>", so rewriting an hour is idempotent. The first time a
+# key is flushed, what is already stored under it (from before a restart, or
+# from before its hour was dropped) is merged in first.
+async def flush(client):
+    loop = asyncio.get_running_loop()
+    keys = AGGREGATOR.take_dirty()
+    if keys:
+        try:
+            new = [AGGREGATOR.rollups[key] for key in keys if key not in persisted]
+            if new:
+                stored = await loop.run_in_executor(None, load_stored, client, new)
+                for rollup in new:
+                    if rollup.id in stored:
+                        rollup.merge(Rollup.from_document(stored[rollup.id]))
+                        stats["merged"] += 1
+                persisted.update((rollup.service_id, rollup.hour) for rollup in new)
+            documents = [
+                (AGGREGATOR.rollups[key].id, AGGREGATOR.rollups[key].document())
+                for key in keys
+            ]
+            failed = await loop.run_in_executor(None, write, client, documents)
+        except Exception as err:
+            print("Failed to flush", len(keys), "rollups:", err)
+            failed = [AGGREGATOR.rollups[key].id for key in keys]
+        # Written again on the next flush
+        failed = set(failed)
+        AGGREGATOR.dirty.update(key for key in keys if AGGREGATOR.rollups[key].id in failed)
+        stats["flushed"] += len(keys) - len(failed)
+        stats["failed"] += len(failed)
+    persisted.difference_update(AGGREGATOR.evict(now_ms()))
+    stats["flushes"] += 1
+
+
+async def flush_loop(client):
+    while True:
+        await asyncio.sleep(FLUSH_INTERVAL)
+        await flush(client)
+        print({**AGGREGATOR.counters, **stats, "rollups": len(AGGREGATOR.rollups)})
+
+
+async def main():
+    client = Elasticsearch(**ELASTICSEARCH_CONFIG)
+    ensure_index(client)
+    loop = asyncio.get_running_loop()
+    server = await loop.create_server(TcpProtocol, "0.0.0.0", TCP_PORT)
+    await loop.create_datagram_endpoint(UdpProtocol, local_addr=("0.0.0.0", UDP_PORT))
+    # `docker stop` sends SIGTERM; flush what is in memory before exiting
+    loop.add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+    print("Listening on tcp", TCP_PORT, "and udp", UDP_PORT, "flushing to", ROLLUP_INDEX)
+    try:
+        await flush_loop(client)
+    except asyncio.CancelledError:
+        pass
+    finally:
+        server.close()
+        await flush(client)
+
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
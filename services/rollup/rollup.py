@@ -0,0 +1,168 @@
+from sketch import LogSketch
+
+HOUR_MS = 3600 * 1000
+
+# Same as services/predict/aggregation.py
+PERCENTILES = [25, 50, 75, 80, 85, 90, 99]
+
+# Rolled-up field -> path in the Kong log record
+FIELDS = {
+    "latency": ["latencies", "request"],
+    "request_size": ["request", "size"],
+    "response_size": ["response", "size"],
+}
+
+
+def lookup(record: dict, path: list):
+    for key in path:
+        if not isinstance(record, dict):
+            return None
+        record = record.get(key)
+    return record
+
+
+class Stats:
+    # What an Elasticsearch `stats` aggregation returns, kept incrementally
+    def __init__(self):
+        self.count = 0
+        self.min = None
+        self.max = None
+        self.sum = 0.0
+
+    def add(self, value: float):
+        self.count += 1
+        self.sum += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def merge(self, other: "Stats"):
+        if other.count:
+            self.count += other.count
+            self.sum += other.sum
+            self.min = other.min if self.min is None else min(self.min, other.min)
+            self.max = other.max if self.max is None else max(self.max, other.max)
+        return self
+
+    def to_dict(self) -> dict:
+        return {
+            "count": self.count,
+            "min": self.min,
+            "max": self.max,
+            "avg": self.sum / self.count if self.count else None,
+            "sum": self.sum,
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "Stats":
+        stats = cls()
+        stats.count = data["count"]
+        stats.min = data["min"]
+        stats.max = data["max"]
+        stats.sum = data["sum"]
+        return stats
+
+
+class Rollup:
+    # One service-hour: request count, stats of every field and a latency
+    # sketch. Stored as a document shaped like one hourly bucket of the
+    # stage_1 aggregation, plus the sketch so that it can be merged again.
+    def __init__(self, service_id: str, hour: int, alpha: float = 0.01):
+        self.service_id = service_id
+        self.hour = hour
+        self.doc_count = 0
+        self.stats = {field: Stats() for field in FIELDS}
+        self.sketch = LogSketch(alpha)
+
+    @property
+    def id(self):
+        return f"{self.service_id}:{self.hour}"
+
+    def add(self, record: dict):
+        self.doc_count += 1
+        for field, path in FIELDS.items():
+            value = lookup(record, path)
+            if isinstance(value, (int, float)):
+                self.stats[field].add(value)
+                if field == "latency":
+                    self.sketch.add(value)
+
+    def merge(self, other: "Rollup"):
+        self.doc_count += other.doc_count
+        for field in FIELDS:
+            self.stats[field].merge(other.stats[field])
+        self.sketch.merge(other.sketch)
+        return self
+
+    def document(self) -> dict:
+        document = {
+            "service_id": self.service_id,
+            "@timestamp": self.hour,
+            "doc_count": self.doc_count,
+            "latency_percentiles": {
+                "values": {
+                    f"{float(percent)}": self.sketch.quantile(percent / 100)
+                    for percent in PERCENTILES
+                }
+            },
+            "latency_sketch": self.sketch.to_dict(),
+        }
+        for field in FIELDS:
+            document[f"{field}_stats"] = self.stats[field].to_dict()
+        return document
+
+    @classmethod
+    def from_document(cls, document: dict) -> "Rollup":
+        sketch = LogSketch.from_dict(document["latency_sketch"])
+        rollup = cls(document["service_id"], document["@timestamp"], sketch.alpha)
+        rollup.doc_count = document["doc_count"]
+        for field in FIELDS:
+            rollup.stats[field] = Stats.from_dict(document[f"{field}_stats"])
+        rollup.sketch = sketch
+        return rollup
+
+
+class Aggregator:
+    # Rollups of the hours still receiving logs, keyed by (service id, hour).
+    # A record goes to the hour it started in (`started_at`, else the time it
+    # arrived). Hours are kept for `grace_ms` after they end, for late
+    # records; once flushed and past that, they are dropped. A record for a
+    # dropped hour starts a new rollup, which the flush merges with the stored
+    # one.
+    def __init__(self, grace_ms: int = 5 * 60 * 1000, alpha: float = 0.01):
+        self.grace_ms = grace_ms
+        self.alpha = alpha
+        self.rollups = {}
+        self.dirty = set()
+        self.counters = {"records": 0, "invalid": 0, "late": 0}
+
+    def add(self, record: dict, now_ms: int):
+        service_id = lookup(record, ["service", "id"])
+        if service_id is None:
+            self.counters["invalid"] += 1
+            return
+        started_at = record.get("started_at")
+        if not isinstance(started_at, (int, float)):
+            started_at = now_ms
+        hour = int(started_at) // HOUR_MS * HOUR_MS
+        key = (service_id, hour)
+        if key not in self.rollups:
+            self.rollups[key] = Rollup(service_id, hour, self.alpha)
+            if hour + HOUR_MS + self.grace_ms <= now_ms:
+                self.counters["late"] += 1
+        self.rollups[key].add(record)
+        self.dirty.add(key)
+        self.counters["records"] += 1
+
+    def take_dirty(self) -> list:
+        keys, self.dirty = self.dirty, set()
+        return keys
+
+    def evict(self, now_ms: int) -> list:
+        expired = [
+            key
+            for key in self.rollups
+            if key not in self.dirty and key[1] + HOUR_MS + self.grace_ms <= now_ms
+        ]
+        for key in expired:
+            del self.rollups[key]
+        return expired
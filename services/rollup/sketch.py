@@ -0,0 +1,66 @@
+import math
+
+
+class LogSketch:
+    # Relative-error quantile sketch (DDSketch): values are counted in
+    # logarithmic bins, so any quantile is within `alpha` of the true value,
+    # the size grows with log(max / min) instead of the number of values, and
+    # two sketches merge by adding their bin counts. Values up to `min_value`
+    # (latencies of 0 ms) are counted as zeros.
+    def __init__(self, alpha: float = 0.01, min_value: float = 1e-3):
+        self.alpha = alpha
+        self.min_value = min_value
+        self.gamma = (1 + alpha) / (1 - alpha)
+        self._log_gamma = math.log(self.gamma)
+        self.bins = {}
+        self.zeros = 0
+        self.count = 0
+
+    def add(self, value: float):
+        if value <= self.min_value:
+            self.zeros += 1
+        else:
+            idx = math.ceil(math.log(value) / self._log_gamma)
+            self.bins[idx] = self.bins.get(idx, 0) + 1
+        self.count += 1
+
+    def merge(self, other: "LogSketch"):
+        assert other.alpha == self.alpha
+        for idx, count in other.bins.items():
+            self.bins[idx] = self.bins.get(idx, 0) + count
+        self.zeros += other.zeros
+        self.count += other.count
+        return self
+
+    def quantile(self, q: float):
+        if not self.count:
+            return None
+        rank = q * (self.count - 1)
+        seen = self.zeros
+        if rank < seen:
+            return 0.0
+        for idx in sorted(self.bins):
+            seen += self.bins[idx]
+            if rank < seen:
+                # Middle of the bin, in relative terms
+                return 2 * self.gamma**idx / (self.gamma + 1)
+        return 2 * self.gamma ** max(self.bins) / (self.gamma + 1)
+
+    # Two parallel lists rather than an object keyed by bin, so the stored
+    # form has a fixed shape
+    def to_dict(self) -> dict:
+        indexes = sorted(self.bins)
+        return {
+            "alpha": self.alpha,
+            "zeros": self.zeros,
+            "indexes": indexes,
+            "counts": [self.bins[idx] for idx in indexes],
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "LogSketch":
+        sketch = cls(alpha=data["alpha"])
+        sketch.bins = dict(zip(data["indexes"], data["counts"]))
+        sketch.zeros = data["zeros"]
+        sketch.count = sketch.zeros + sum(data["counts"])
+        return sketch